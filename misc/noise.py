@@ -63,7 +63,7 @@ def simplex_gradient_2d(h, x, y):
     else:
         u = y
         v = 2.0 * x
-    return ((h & 1) if u < 0 else u) + ((h & 2) if v < 0 else v)
+    return (-u if (h & 1) else u) + (-v if (h & 2) else v)
 
 
 def simplex_gradient_3d(h, x, y, z):
@@ -82,6 +82,41 @@ def simplex_gradient_4d(h, x, y, z, t):
     return (-u if (h & 1) else u ) + (-v if (h & 2) else v) + (-w if (h & 4) else w)
 
 
+def simplex_gradient_1d_array(h, x):
+    h = h & 0xF
+    grad = 1.0 + (h & 7)
+    return np.where(h & 8, -grad, grad) * x
+
+
+def simplex_gradient_2d_array(h, x, y):
+    h = h & 0x7
+    u = np.where(h < 4, x, y)
+    v = np.where(h < 4, 2.0 * y, 2.0 * x)
+    return np.where(h & 1, -u, u) + np.where(h & 2, -v, v)
+
+
+def simplex_gradient_3d_array(h, x, y, z):
+    h = h & 0xF
+    u = np.where(h < 8, x, y)
+    v = np.where(h < 4, y, np.where((h == 12) | (h == 14), x, z))
+    return np.where(h & 1, -u, u) + np.where(h & 2, -v, v)
+
+
+def simplex_gradient_4d_array(h, x, y, z, t):
+    h = h & 0x1F
+    u = np.where(h < 24, x, y)
+    v = np.where(h < 16, y, z)
+    w = np.where(h < 8, z, t)
+    return np.where(h & 1, -u, u) + np.where(h & 2, -v, v) + np.where(h & 4, -w, w)
+
+
+# Corner offsets (i1, j1, k1, i2, j2, k2) of the 3d simplex, one row per ordering of x0, y0, z0.
+simplex_3d_offsets = np.array([
+    [1, 0, 0, 1, 1, 0], [1, 0, 0, 1, 0, 1], [0, 0, 1, 1, 0, 1],
+    [0, 0, 1, 0, 1, 1], [0, 1, 0, 0, 1, 1], [0, 1, 0, 1, 1, 0]
+])
+
+
 # wavelet noise, adapted libtcod which is adapted from Robert L. Cook and Tony Derose 'Wavelet noise' paper
 acoeffs = np.array([
     0.000334, -0.001528, 0.000410, 0.003545, -0.000938, -0.008233, 0.002172, 0.019120,
@@ -96,32 +131,96 @@ def absmod(x, n):
     return m + n if m < 0 else m
 
 
+pcoeffs = np.array([0.25, 0.75, 0.75, 0.25])
+
+
 def noise_wavelet_downsample(wav_from, wav_to, stride):
-    for i in range(WAVELET_TILE_SIZE / 2):
+    for i in range(WAVELET_TILE_SIZE // 2):
+        wav_to[i * stride] = 0
+        for k in range(2 * i - WAVELET_ARAD, 2 * i + WAVELET_ARAD):
+            wav_to[i * stride] += acoeffs[k - 2 * i + WAVELET_ARAD] * wav_from[absmod(k, WAVELET_TILE_SIZE) * stride]
+
+
+def noise_wavelet_upsample(wav_from, wav_to, stride):
+    for i in range(WAVELET_TILE_SIZE):
         wav_to[i * stride] = 0
+        for k in range(i // 2, i // 2 + 2):
+            wav_to[i * stride] += pcoeffs[i - 2 * k + 2] * wav_from[absmod(k, WAVELET_TILE_SIZE // 2) * stride]
+
+
+def wavelet_filter_matrix():
+    """Matrix applying noise_wavelet_downsample then noise_wavelet_upsample to a tile row."""
+    n = WAVELET_TILE_SIZE
+    down = np.zeros((n // 2, n))
+    for i in range(n // 2):
         for k in range(2 * i - WAVELET_ARAD, 2 * i + WAVELET_ARAD):
-            wav_to[i * stride] += acoeffs[k - 2 * i] * wav_from[absmod(k, WAVELET_TILE_SIZE) * stride]
+            down[i, absmod(k, n)] += acoeffs[k - 2 * i + WAVELET_ARAD]
+    up = np.zeros((n, n // 2))
+    for i in range(n):
+        for k in range(i // 2, i // 2 + 2):
+            up[i, absmod(k, n // 2)] += pcoeffs[i - 2 * k + 2]
+    return up.dot(down)
+
+
+def make_wavelet_tile(random):
+    """Build a wavelet noise tile from `random(shape)` values uniform in [0, 1).
+
+    The tile is indexed [z, y, x], like libtcod's flat tile data.
+    """
+    n = WAVELET_TILE_SIZE
+    noise = 2.0 * random((n, n, n)) - 1.0
+    # Remove the low band: downsample and upsample along x, then y, then z.
+    band = wavelet_filter_matrix()
+    low = np.einsum('ij,zyj->zyi', band, noise)
+    low = np.einsum('ij,zjx->zix', band, low)
+    low = np.einsum('ij,jyx->iyx', band, low)
+    noise = noise - low
+    offset = n // 2
+    if (offset & 1) == 0:
+        offset += 1
+    return noise + np.roll(noise, -offset, axis=(0, 1, 2)).transpose(2, 1, 0)
+
+
+_wavelet_tiles = {}
+
+
+def wavelet_tile(seed):
+    "The wavelet noise tile for `seed`, computed once and cached."
+    if seed not in _wavelet_tiles:
+        _wavelet_tiles[seed] = make_wavelet_tile(np.random.RandomState(seed).random_sample)
+    return _wavelet_tiles[seed]
 
 
 class NoiseGenerator(object):
-    def __init__(self, dimensions, lacunarity=DEFAULT_LACUNARITY, hurst=DEFAULT_HURST, random=np.random.random, noise_type='PERLIN'):
+    def __init__(self, dimensions, lacunarity=DEFAULT_LACUNARITY, hurst=DEFAULT_HURST, random=np.random.random, noise_type='PERLIN',
+                 seed=None):
         """
 
         @param dimensions:
         @param lacunarity:
         @param hurst:
         @param random:
+        @param seed: If given, the gradients and permutation table of the perlin
+        and simplex noise are drawn from a generator seeded with it instead of
+        `random` and the global numpy state, and the wavelet tile is built from
+        it and shared with every generator using the same seed.
         """
+        self.seed = seed
+        self.wavelet_tile_data = None
         self.noise_type = noise_type
         self.ndim = dimensions
         self.lacunarity = lacunarity
         self.hurst = hurst
-        self.rng = random
+        if seed is None:
+            self.rng, shuffle = random, np.random.shuffle
+        else:
+            seeded = np.random.default_rng(seed)
+            self.rng, shuffle = seeded.random, seeded.shuffle
         self.map = np.arange(256)
         self.buffer = np.zeros((256, dimensions))
         for i in range(256):
             self.buffer[i, :] = self.normalize(self.rng(self.ndim) - 0.5)
-        np.random.shuffle(self.map)
+        shuffle(self.map)
         self.exponent = np.zeros(NOISE_MAX_OCTAVES)
         f = 1.0
         for i in range(NOISE_MAX_OCTAVES):
@@ -150,6 +249,9 @@ class NoiseGenerator(object):
         return value
 
     def perlin_noise(self, f):
+        """Perlin noise at point `f`, or at every row of an (N, ndim) array of points."""
+        if np.ndim(f) == 2:
+            return self.perlin_noise_array(f)
         n = np.floor(f)
         r = f - n
         w = cubic(r)
@@ -204,7 +306,7 @@ class NoiseGenerator(object):
                          lerp(lerp(self.lattice(n[0], r[0], n[1], r[1], n[2] + 1, r[2] - 1, n[3], r[3]),
                                    self.lattice(n[0] + 1, r[0] - 1, n[1], r[1], n[2] + 1, r[2] - 1, n[3], r[3]),
                                    w[0]),
-                              lerp(self.lattice(n[0], r[0], n[1] + 1, r[1] - 1, n[2] + 1, r[2] - 1, 0, 0),
+                              lerp(self.lattice(n[0], r[0], n[1] + 1, r[1] - 1, n[2] + 1, r[2] - 1, n[3], r[3]),
                                    self.lattice(n[0] + 1, r[0] - 1, n[1] + 1, r[1] - 1, n[2] + 1, r[2] - 1, n[3],
                                                 r[3]),
                                    w[0]),
@@ -222,7 +324,8 @@ class NoiseGenerator(object):
                                    self.lattice(n[0] + 1, r[0] - 1, n[1], r[1], n[2] + 1, r[2] - 1, n[3] + 1,
                                                 r[3] - 1),
                                    w[0]),
-                              lerp(self.lattice(n[0], r[0], n[1] + 1, r[1] - 1, n[2] + 1, r[2] - 1, 0, 0),
+                              lerp(self.lattice(n[0], r[0], n[1] + 1, r[1] - 1, n[2] + 1, r[2] - 1, n[3] + 1,
+                                                r[3] - 1),
                                    self.lattice(n[0] + 1, r[0] - 1, n[1] + 1, r[1] - 1, n[2] + 1, r[2] - 1,
                                                 n[3] + 1,
                                                 r[3] - 1),
@@ -232,8 +335,11 @@ class NoiseGenerator(object):
                     w[3])
 
     def simplex_noise(self, f):
+        """Simplex noise at point `f`, or at every row of an (N, ndim) array of points."""
+        if np.ndim(f) == 2:
+            return self.simplex_noise_array(f)
         if self.ndim == 1:
-            return self.simplex_noise_1d(f)
+            return self.simplex_noise_1d(f[0])
         if self.ndim == 2:
             return self.simplex_noise_2d(f)
         if self.ndim == 3:
@@ -491,7 +597,7 @@ class NoiseGenerator(object):
             idx = self.map[
                 (ii + i1 + self.map[(jj + j1 + self.map[(kk + k1 + self.map[(ll + l1) & 0xFF]) & 0xFF]) & 0xFF]) & 0xFF]
             t1 *= t1
-            n1 = simplex_gradient_4d(idx, x1, y1, z2, w1)
+            n1 = simplex_gradient_4d(idx, x1, y1, z1, w1)
             n1 *= t1 * t1
 
         t2 = 0.6 - x2 * x2 - y2 * y2 - z2 * z2 - w2 * w2
@@ -529,15 +635,182 @@ class NoiseGenerator(object):
 
         return 27.0 * (n0 + n1 + n2 + n3 + n4)
 
+    # Array versions of perlin_noise and simplex_noise: each takes an (N, ndim)
+    # array of points and returns the N noise values, matching the scalar path.
+
+    def perlin_noise_array(self, f):
+        f = np.asarray(f, dtype=float)
+        n = np.floor(f)
+        r = f - n
+        w = cubic(r)
+        n = n.astype(np.int64)
+        corners = []
+        for c in range(1 << self.ndim):
+            bits = [(c >> i) & 1 for i in range(self.ndim)]
+            n_index = np.zeros(len(f), np.int64)
+            for i in range(self.ndim):
+                n_index = self.map[(n_index + n[:, i] + bits[i]) & 0xFF]
+            value = 0
+            for i in range(self.ndim):
+                value = value + self.buffer[n_index, i] * (r[:, i] - bits[i])
+            corners.append(value)
+        # Interpolate along x first, then y, z and w, like the nested lerps above
+        for i in range(self.ndim):
+            corners = [lerp(corners[k], corners[k + 1], w[:, i]) for k in range(0, len(corners), 2)]
+        return np.clip(corners[0], -0.99999, 0.99999)
+
+    def simplex_noise_array(self, f):
+        f = np.asarray(f, dtype=float)
+        if self.ndim == 1:
+            return self.simplex_noise_1d_array(f[:, 0])
+        if self.ndim == 2:
+            return self.simplex_noise_2d_array(f)
+        if self.ndim == 3:
+            return self.simplex_noise_3d_array(f)
+        if self.ndim == 4:
+            return self.simplex_noise_4d_array(f)
+
+    def simplex_corner(self, t, idx, grad, *coords):
+        "Contribution of one simplex corner, zero where `t` is negative."
+        return np.where(t < 0.0, 0.0, t * t * t * t * grad(idx, *coords))
+
+    def simplex_noise_1d_array(self, f):
+        i0 = np.floor(f * SIMPLEX_SCALE).astype(np.int64)
+        x0 = f * SIMPLEX_SCALE - i0
+        x1 = x0 - 1.0
+        t0 = 1.0 - x0 * x0
+        t1 = 1.0 - x1 * x1
+        n0 = simplex_gradient_1d_array(self.map[i0 & 0xFF], x0) * (t0 * t0) ** 2
+        n1 = simplex_gradient_1d_array(self.map[(i0 + 1) & 0xFF], x1) * (t1 * t1) ** 2
+        return 0.25 * (n0 + n1)
+
+    def simplex_noise_2d_array(self, f):
+        F2 = 0.366025403  # 0.5 * (sqrt(3.0)-1.0)
+        g2 = 0.211324865  # (3.0 - sqrt(3.0)/6.0
+        m = self.map
+        x, y = f[:, 0] * SIMPLEX_SCALE, f[:, 1] * SIMPLEX_SCALE
+        s = (f[:, 0] + f[:, 1]) * F2 * SIMPLEX_SCALE
+        i = np.floor(x + s).astype(np.int64)
+        j = np.floor(y + s).astype(np.int64)
+        t = (i + j) * g2
+        x0 = x - (i - t)
+        y0 = y - (j - t)
+        ii, jj = i % 256, j % 256
+        i1 = (x0 > y0).astype(np.int64)
+        j1 = 1 - i1
+        x1, y1 = x0 - i1 + g2, y0 - j1 + g2
+        x2, y2 = x0 - 1.0 + 2.0 * g2, y0 - 1.0 + 2.0 * g2
+        grad = simplex_gradient_2d_array
+        n0 = self.simplex_corner(0.5 - x0 * x0 - y0 * y0, m[(ii + m[jj]) & 0xFF], grad, x0, y0)
+        n1 = self.simplex_corner(0.5 - x1 * x1 - y1 * y1,
+                                 m[(ii + i1 + m[(jj + j1) & 0xFF]) & 0xFF], grad, x1, y1)
+        n2 = self.simplex_corner(0.5 - x2 * x2 - y2 * y2,
+                                 m[(ii + 1 + m[(jj + 1) & 0xFF]) & 0xFF], grad, x2, y2)
+        return 40.0 * (n0 + n1 + n2)
+
+    def simplex_noise_3d_array(self, f):
+        F3 = 0.333333333
+        G3 = 0.166666667
+        m = self.map
+        x, y, z = f[:, 0] * SIMPLEX_SCALE, f[:, 1] * SIMPLEX_SCALE, f[:, 2] * SIMPLEX_SCALE
+        s = (f[:, 0] + f[:, 1] + f[:, 2]) * F3 * SIMPLEX_SCALE
+        i = np.floor(x + s).astype(np.int64)
+        j = np.floor(y + s).astype(np.int64)
+        k = np.floor(z + s).astype(np.int64)
+        t = (i + j + k) * G3
+        x0, y0, z0 = x - (i - t), y - (j - t), z - (k - t)
+        xy, yz, xz = x0 >= y0, y0 >= z0, x0 >= z0
+        case = np.select([xy & yz, xy & xz, xy, ~yz, ~xz], [0, 1, 2, 3, 4], 5)
+        i1, j1, k1, i2, j2, k2 = simplex_3d_offsets[case].T
+        corners = [(x0, y0, z0, 0, 0, 0),
+                   (x0 - i1 + G3, y0 - j1 + G3, z0 - k1 + G3, i1, j1, k1),
+                   (x0 - i2 + 2.0 * G3, y0 - j2 + 2.0 * G3, z0 - k2 + 2.0 * G3, i2, j2, k2),
+                   (x0 - 1.0 + 3.0 * G3, y0 - 1.0 + 3.0 * G3, z0 - 1.0 + 3.0 * G3, 1, 1, 1)]
+        ii, jj, kk = i % 256, j % 256, k % 256
+        total = 0
+        for xc, yc, zc, di, dj, dk in corners:
+            idx = m[(ii + di + m[(jj + dj + m[(kk + dk) & 0xFF]) & 0xFF]) & 0xFF]
+            total = total + self.simplex_corner(0.6 - xc * xc - yc * yc - zc * zc, idx,
+                                                simplex_gradient_3d_array, xc, yc, zc)
+        return 32.0 * total
+
+    def simplex_noise_4d_array(self, f):
+        F4 = 0.309016994  # (sqrtf(5.0f)-1.0f)/4.0f
+        G4 = 0.138196601  # (5.0f - sqrtf(5.0f))/20.0f
+        m = self.map
+        p = f * SIMPLEX_SCALE
+        s = f.sum(axis=1) * F4 * SIMPLEX_SCALE
+        cell = np.floor(p + s[:, None]).astype(np.int64)
+        t = cell.sum(axis=1) * G4
+        p0 = p - (cell - t[:, None])
+        x0, y0, z0, w0 = p0.T
+        c = (32 * (x0 > y0) + 16 * (x0 > z0) + 8 * (y0 > z0)
+             + 4 * (x0 > w0) + 2 * (y0 > w0) + (z0 > w0))
+        rank = simplex[c]
+        wrapped = cell % 256
+        total = 0
+        for corner in range(5):
+            if corner == 0:
+                offset = np.zeros_like(cell)
+            elif corner == 4:
+                offset = np.ones_like(cell)
+            else:
+                offset = (rank >= 4 - corner).astype(np.int64)
+            pc = p0 - offset + corner * G4
+            idx = m[(wrapped[:, 3] + offset[:, 3]) & 0xFF]
+            for axis in (2, 1, 0):
+                idx = m[(wrapped[:, axis] + offset[:, axis] + idx) & 0xFF]
+            total = total + self.simplex_corner(0.6 - (pc * pc).sum(axis=1), idx,
+                                                simplex_gradient_4d_array, *pc.T)
+        return 27.0 * total
+
+    def wavelet_noise(self, f):
+        """Wavelet noise at point `f`, or at every row of an (N, ndim) array of points.
+
+        Only 1 to 3 dimensions are supported, higher ones give 0.
+        """
+        if np.ndim(f) == 2:
+            return self.wavelet_noise_array(f)
+        return float(self.wavelet_noise_array(np.reshape(f, (1, -1)))[0])
+
+    def wavelet_noise_array(self, f):
+        f = np.asarray(f, dtype=float)
+        if self.ndim > 3:
+            return np.zeros(len(f))
+        if self.wavelet_tile_data is None:
+            if self.seed is None:
+                self.wavelet_tile_data = make_wavelet_tile(self.rng)
+            else:
+                self.wavelet_tile_data = wavelet_tile(self.seed)
+        tile = self.wavelet_tile_data
+        pf = np.zeros((len(f), 3))
+        pf[:, :self.ndim] = f * WAVELET_SCALE
+        mid = np.ceil(pf - 0.5).astype(np.int64)
+        t = mid - (pf - 0.5)
+        w0 = t * t * 0.5
+        w2 = (1.0 - t) * (1.0 - t) * 0.5
+        weights = (w0, 1.0 - w0 - w2, w2)
+        mask = WAVELET_TILE_SIZE - 1
+        result = 0
+        for pz in (-1, 0, 1):
+            for py in (-1, 0, 1):
+                for px in (-1, 0, 1):
+                    weight = weights[px + 1][:, 0] * weights[py + 1][:, 1] * weights[pz + 1][:, 2]
+                    c = mid + (px, py, pz)
+                    result = result + weight * tile[c[:, 2] & mask, c[:, 1] & mask, c[:, 0] & mask]
+        return np.clip(result, -1.0, 1.0)
+
     def noise_fbm_int(self, f, octaves, func):
-        tf = np.array(f)
+        tf = np.array(f, dtype=float)
         value = 0
-        for i in range(octaves):
+        for i in range(int(octaves)):
             value += func(tf) * self.exponent[i]
             tf *= self.lacunarity
-        octaves -= floor(octaves)
-        if octaves > DELTA:
-            value += octaves * func(tf) * self.exponent[i]
+        frac = octaves - floor(octaves)
+        if frac > DELTA:
+            value += frac * func(tf) * self.exponent[int(octaves)]
+        if np.ndim(value):
+            return np.clip(value, -0.99999, 0.99999)
         return clamp(-0.99999, 0.99999, value)
 
     def noise_fbm_perlin(self, f, octaves):
@@ -546,7 +819,11 @@ class NoiseGenerator(object):
     def noise_fbm_simplex(self, f, octaves):
         return self.noise_fbm_int(f, octaves, self.simplex_noise)
 
+    def noise_fbm_wavelet(self, f, octaves):
+        return self.noise_fbm_int(f, octaves, self.wavelet_noise)
+
     def get_fbm(self, coord, octaves, type=None):
+        """Fractal brownian motion at point `coord`, or at every row of an (N, ndim) array."""
         if type is None:
             type = self.noise_type
         if type == 'PERLIN':
@@ -0,0 +1,19 @@
+import pytest
+from worldgen import WorldGenerator
+
+
+@pytest.fixture
+def make_world(request):
+    """Factory of small WorldGenerators: make_world(seed=3, **settings).
+
+    Parametrize indirectly with a dict to change the defaults of a test:
+
+        @pytest.mark.parametrize('make_world', [dict(width=96, seed=5)], indirect=True)
+    """
+    defaults = dict(width=48, height=32, seed=3, hill_cnt=30)
+    defaults.update(getattr(request, 'param', {}))
+
+    def make(seed=defaults['seed'], **kwargs):
+        return WorldGenerator(**dict(defaults, seed=seed, **kwargs))
+
+    return make
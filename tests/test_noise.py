@@ -0,0 +1,72 @@
+import os
+import sys
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'misc'))
+import noise
+from noise import NoiseGenerator, WAVELET_TILE_SIZE
+
+
+def test_array_noise_matches_scalar_path():
+    for ndim in (1, 2, 3, 4):
+        np.random.seed(ndim)
+        gen = NoiseGenerator(ndim)
+        points = np.random.rand(50, ndim) * 40 - 20
+        for func in (gen.perlin_noise, gen.simplex_noise):
+            expected = [func(p) for p in points]
+            assert np.allclose(func(points), expected, atol=1e-12)
+
+
+def test_array_fbm_matches_scalar_path():
+    gen = NoiseGenerator(2)
+    points = np.random.rand(50, 2) * 10
+    for noise_type in ('PERLIN', 'SIMPLEX'):
+        expected = [gen.get_fbm(p, 3.5, noise_type) for p in points]
+        assert np.allclose(gen.get_fbm(points, 3.5, noise_type), expected, atol=1e-12)
+
+
+def reference_wavelet_tile(values):
+    "Build a wavelet tile with the scalar filters, following libtcod's flat tile layout."
+    n = WAVELET_TILE_SIZE
+    tile = values.ravel().copy()
+    temp1, temp2 = np.zeros(n ** 3), np.zeros(n ** 3)
+    passes = [(tile, 1, lambda a, b: a * n + b * n * n),
+              (temp2, n, lambda a, b: a + b * n * n),
+              (temp2, n * n, lambda a, b: a + b * n)]
+    for src, stride, start_of in passes:
+        for a in range(n):
+            for b in range(n):
+                start = start_of(a, b)
+                noise.noise_wavelet_downsample(src[start:], temp1[start:], stride)
+                noise.noise_wavelet_upsample(temp1[start:], temp2[start:], stride)
+    tile -= temp2
+    rolled = [tile[(x + 17) % n + (y + 17) % n * n + (z + 17) % n * n * n]
+              for x in range(n) for y in range(n) for z in range(n)]
+    return (tile + rolled).reshape(n, n, n)
+
+
+def test_wavelet_tile_matches_scalar_filters():
+    values = np.random.RandomState(5).random_sample((WAVELET_TILE_SIZE,) * 3)
+    expected = reference_wavelet_tile(2.0 * values - 1.0)
+    tile = noise.make_wavelet_tile(np.random.RandomState(5).random_sample)
+    assert np.allclose(tile, expected)
+
+
+def test_wavelet_noise():
+    gen = NoiseGenerator(2, seed=3)
+    points = np.random.rand(30, 2) * 10
+    values = gen.wavelet_noise(points)
+    assert np.allclose(values, [gen.wavelet_noise(p) for p in points])
+    assert (np.abs(values) <= 1.0).all()
+    assert noise.wavelet_tile(3) is gen.wavelet_tile_data
+    other = NoiseGenerator(2, seed=3)
+    assert np.allclose(other.get_fbm(points, 4, 'WAVELET'), gen.get_fbm(points, 4, 'WAVELET'))
+
+
+def test_seed_fixes_perlin_and_simplex():
+    points = np.random.rand(20, 2) * 10
+    a, b = NoiseGenerator(2, seed=4), NoiseGenerator(2, seed=4)
+    for noise_type in ('PERLIN', 'SIMPLEX'):
+        assert np.allclose(a.get_fbm(points, 4, noise_type), b.get_fbm(points, 4, noise_type))
+    assert not np.allclose(NoiseGenerator(2, seed=5).get_fbm(points, 4, 'PERLIN'),
+                           a.get_fbm(points, 4, 'PERLIN'))
@@ -0,0 +1,384 @@
+import numpy as np
+import pytest
+import worldgen
+from worldgen import WorldGenerator, SAND_HEIGHT, dirx, diry, dircoef, oppdir
+
+
+def make_world(width=48, height=40, seed=1):
+    wg = WorldGenerator(width, height, seed=seed)
+    rng = np.random.RandomState(seed)
+    yy, xx = np.mgrid[0:height, 0:width]
+    hm = 0.5 + 0.3 * np.sin(xx / 7.0) * np.cos(yy / 5.0) + 0.05 * rng.rand(height, width)
+    wg._hm[:] = hm
+    wg._precipitation[:] = rng.rand(height, width)
+    return wg
+
+
+def reference_erode_map(wg, iterations=4):
+    "The original per-cell erosion loop, visiting all eight neighbours without wrapping."
+    hm = wg._hm.copy()
+    height, width = hm.shape
+    precip = worldgen.precipitation_to_cm(wg._precipitation)
+    for _ in range(iterations):
+        flow = np.zeros(hm.shape, int)
+        slope = np.zeros(hm.shape)
+        for y in range(height):
+            for x in range(width):
+                h = hm[y, x]
+                hmin, min_dir = h, 0
+                for i in range(1, 9):
+                    ix, iy = x + dirx[i], y + diry[i]
+                    if 0 <= ix < width and 0 <= iy < height and hm[iy, ix] < hmin:
+                        hmin, min_dir = hm[iy, ix], i
+                flow[y, x] = min_dir
+                slope[y, x] = (hmin - h) * dircoef[min_dir]
+        for y in range(height):
+            for x in range(width):
+                sediment, ix, iy, old_flow = 0, x, y, flow[y, x]
+                while True:
+                    h = hm[iy, ix]
+                    if h < SAND_HEIGHT - 0.01:
+                        break
+                    if flow[iy, ix] == oppdir[old_flow]:
+                        hm[iy, ix] = h + wg.sedimentation_factor * sediment
+                        break
+                    h += precip[iy, ix] * wg.erosion_factor * slope[iy, ix]
+                    hm[iy, ix] = max(h, SAND_HEIGHT)
+                    sediment -= slope[iy, ix]
+                    old_flow = flow[iy, ix]
+                    ix += dirx[old_flow]
+                    iy += diry[old_flow]
+    return worldgen.mudslide(hm, wg.max_erosion_alt, wg.mudslide_coef)
+
+
+def test_erode_map_matches_reference():
+    wg = make_world()
+    expected = reference_erode_map(wg)
+    wg.erode_map()
+    assert wg._hm.dtype == np.float32
+    assert np.allclose(wg._hm, expected, atol=1e-5)
+
+
+def test_flow_directions_point_downhill():
+    wg = make_world()
+    flow_dir, up_dir, slope = worldgen.flow_directions(wg._hm)
+    assert flow_dir.dtype == np.int8 and up_dir.dtype == np.int8
+    assert (slope <= 0).all()
+    assert ((flow_dir == 0) == (slope == 0)).all()
+
+
+def test_map_data_grid_views():
+    grid = worldgen.MapDataGrid(4096, 4096)
+    assert grid.nbytes < 512 * 1024 * 1024
+    grid = worldgen.MapDataGrid(5, 3)
+    cell = grid[2, 4]
+    cell.river_id = 7
+    cell.slope = -0.5
+    assert grid.river_id[2, 4] == 7 and grid[2, 4].river_id == 7
+    assert grid.slope[2, 4] == -0.5
+    assert grid.river_id.sum() == 7
+
+
+def test_inflow_flags_match_flow_directions():
+    wg = make_world()
+    wg.erode_map()
+    md = wg.map_data
+    y, x = np.argwhere(md.in_flags > 0)[0]
+    for i in range(1, 9):
+        ix, iy = x + dirx[i], y + diry[i]
+        drains = (0 <= ix < wg.width and 0 <= iy < wg.height
+                  and md.flow_dir[iy, ix] == oppdir[i])
+        assert bool(md.in_flags[y, x] & (1 << (i - 1))) == drains
+
+
+def test_set_land_mass_ratio():
+    wg = make_world(64, 64)
+    wg.set_land_mass(0.6, SAND_HEIGHT)
+    assert abs((wg._hm > SAND_HEIGHT).mean() - 0.6) < 0.02
+    wg = make_world(64, 64)
+    wg.set_land_mass(0.6, SAND_HEIGHT, exact=True)
+    assert abs((wg._hm > SAND_HEIGHT).mean() - 0.6) < 1.0 / wg._hm.size
+
+
+def test_stamp_hills_matches_tcod():
+    import tcod
+    rng = np.random.RandomState(0)
+    xs, ys = rng.randint(0, 50, 40), rng.randint(0, 30, 40)
+    radii, heights = rng.randint(2, 12, 40), rng.rand(40)
+    expected = np.zeros((30, 50), np.float32)
+    for x, y, r, h in zip(xs, ys, radii, heights):
+        tcod.heightmap_add_hill(expected, x, y, r, h)
+    for tile_size in (None, 16):
+        hm = np.zeros((30, 50), np.float32)
+        worldgen.stamp_hills(hm, xs, ys, radii, heights, tile_size=tile_size)
+        assert np.allclose(hm, expected, atol=1e-5)
+
+
+def test_zero_radius_hills_add_nothing():
+    for tile_size in (None, 4):
+        hm = np.zeros((10, 10), np.float32)
+        worldgen.stamp_hills(hm, [5], [5], [0], [0.6], tile_size=tile_size)
+        assert not hm.any()
+
+
+def test_small_maps_generate():
+    # Narrower than 21 cells, the smallest hill radius rounds to 0
+    for size in (10, 16, 20):
+        wg = WorldGenerator(size, size, seed=1)
+        wg.generate()
+        assert np.isfinite(wg._hm).all()
+
+
+def test_sample_noise_matches_noise_get_fbm():
+    import tcod
+    noise = tcod.noise_new(2)
+    xs, ys = np.linspace(0, 6, 9), np.linspace(0, 6, 7)
+    grid = worldgen.sample_noise(noise, (xs[None, :], ys[:, None]), 4.0)
+    expected = [[tcod.noise_get_fbm(noise, [x, y], 4.0, tcod.NOISE_SIMPLEX) for x in xs]
+                for y in ys]
+    assert grid.shape == (7, 9) and grid.dtype == np.float32
+    assert np.allclose(grid, expected)
+
+
+def test_box_blur_matches_direct_average():
+    arr = np.random.RandomState(0).rand(9, 12).astype(np.float32)
+    expected = arr.astype(np.float64)
+    for _ in range(2):
+        rows = np.array([[expected[y, max(0, x - 2):x + 3].mean() for x in range(12)]
+                         for y in range(9)])
+        expected = np.array([[rows[max(0, y - 2):y + 3, x].mean() for x in range(12)]
+                             for y in range(9)])
+    blurred = worldgen.box_blur(arr, radius=2, passes=2)
+    assert blurred.dtype == np.float32
+    assert np.allclose(blurred, expected, atol=1e-6)
+
+
+def test_block_reduce_and_interpolate_bilinear():
+    arr = np.arange(35, dtype=np.float32).reshape(5, 7)
+    small = worldgen.block_reduce(arr, 4)
+    assert small.shape == (2, 2)
+    assert small[0, 0] == arr[:4, :4].sum() and small[1, 1] == arr[4:, 4:].sum()
+    xs, ys = np.array([0.0, 2.5, 6.0, 9.0]), np.array([0.0, 1.25, 4.0])
+    grid = worldgen.interpolate_bilinear(arr, xs[None, :], ys[:, None])
+    expected = [[y * 7 + x for x in (0.0, 2.5, 6.0, 6.0)] for y in (0.0, 1.25, 4.0)]
+    assert np.allclose(grid, expected)
+    assert np.isclose(worldgen.interpolate_bilinear(arr, 2.5, 1.25), 1.25 * 7 + 2.5)
+
+
+def reference_sweep(hm, precip, water, step, water_add=0.03, slope_coef=2.0, base_precip=0.01):
+    n = hm.shape[0]
+    for x in range(len(water)):
+        water_amount = float(water[x])
+        for y in (range(n) if step == 1 else range(n - 1, -1, -1)):
+            h = hm[y, x]
+            if h < SAND_HEIGHT:
+                water_amount += water_add
+            elif water_amount > 0.0:
+                slope = hm[y + step, x] - h if 0 <= y + step < n else h - hm[y - step, x]
+                if slope >= 0:
+                    rain = water_amount * (base_precip + slope * slope_coef)
+                    precip[y, x] += rain
+                    water_amount = max(0.0, water_amount - rain)
+
+
+def test_precipitation_sweep_matches_sequential_scan():
+    import worldgen_kernels as kernels
+    hm = make_world(150, 70)._hm
+    for step in (-1, 1):
+        for view in (hm, hm.T):
+            water = np.random.RandomState(0).rand(view.shape[1] - 1).astype(np.float32) + 0.5
+            expected = np.zeros(view.shape, np.float32)
+            reference_sweep(view, expected, water, step)
+            precip = np.zeros(hm.shape, np.float32)
+            out = precip if view is hm else precip.T
+            kernels.precipitation_sweep(view, out, water, step, 0.03, 2.0, 0.01, SAND_HEIGHT)
+            assert np.allclose(out, expected, atol=1e-6)
+
+
+def test_biomes_match_climate_diagram():
+    wg = make_world(40, 30)
+    wg.compute_temperatures_and_biomes()
+    assert wg._biome_map.dtype == np.uint8 and wg._biome_map.shape == (30, 40)
+    for y, x in [(0, 0), (15, 20), (29, 39), (7, 33)]:
+        climate = worldgen.get_climate_from_temp(wg.temperature(x, y))
+        i_humid = int(min(4, round(wg._precipitation[y, x] * 5)))
+        assert wg.biome(x, y) == worldgen.biome_diagram[climate.value][i_humid].value
+
+
+def test_color_ramp_matches_tcod():
+    import tcod
+    for ramp, indexes, keys in [
+            (worldgen.altitude_ramp, worldgen.altIndexes, worldgen.altrgb_color_ints),
+            (worldgen.precipitation_ramp, worldgen.precIndexes, worldgen.precrgb_color_ints)]:
+        colors = [tcod.Color(*c) for c in keys]
+        expected = [tuple(c) for c in tcod.color_gen_map(colors, indexes)]
+        assert [tuple(c) for c in ramp] == expected
+
+
+def test_compute_colors():
+    wg = make_world(40, 30)
+    wg.compute_temperatures_and_biomes()
+    wg.compute_colors()
+    for view in ('land', 'altitude', 'precipitation', 'temperature', 'biome'):
+        assert wg._colors[view].shape == (30, 40, 3) and wg._colors[view].dtype == np.uint8
+    assert tuple(wg.biome_color(3, 4)) == tuple(wg._colors['biome'][4, 3])
+
+
+def test_real_altitude_and_precipitation_arrays():
+    wg = make_world(40, 30)
+    alt = wg.real_altitude()
+    assert alt.shape == (30, 40)
+    assert np.isclose(wg.real_altitude(5, 7), alt[7, 5], atol=1e-3)
+    xs, ys = np.array([0, 12, 39]), np.array([29, 3, 0])
+    assert np.allclose(wg.real_altitude(xs, ys), alt[ys, xs], atol=1e-3)
+    prec = wg.precipitation()
+    for x, y in zip(xs, ys):
+        iprec = min(255, 256 * wg._precipitation[y, x])
+        i0, i1 = worldgen.find_index(worldgen.precIndexes, iprec)
+        expected = worldgen.precipitations[i0] + (
+            worldgen.precipitations[i1] - worldgen.precipitations[i0]) * (
+            iprec - worldgen.precIndexes[i0]) / (worldgen.precIndexes[i1] - worldgen.precIndexes[i0])
+        if iprec >= worldgen.precIndexes[0]:
+            assert np.isclose(prec[y, x], expected)
+    assert np.allclose(wg.precipitation(xs, ys), prec[ys, xs])
+
+
+def test_flow_accumulation_matches_downstream_walks():
+    wg = make_world()
+    flow_dir, _, _ = worldgen.flow_directions(wg._hm)
+    expected = np.zeros(flow_dir.shape)
+    for y in range(wg.height):
+        for x in range(wg.width):
+            ix, iy = x, y
+            while True:
+                expected[iy, ix] += wg._precipitation[y, x]
+                d = flow_dir[iy, ix]
+                if d == 0:
+                    break
+                ix, iy = ix + dirx[d], iy + diry[d]
+    area = worldgen.flow_accumulation(flow_dir, wg._precipitation)
+    assert np.allclose(area, expected, rtol=1e-5)
+
+
+def test_generate_rivers():
+    wg = make_world(64, 64)
+    wg.generate_rivers(min_area=5.0)
+    md = wg.map_data
+    assert wg.rivers
+    assert ((md.river_id > 0) == ((md.area >= 5.0) & (wg._hm >= SAND_HEIGHT))).all()
+    assert (wg._precipitation[md.river_id > 0] == 1.0).all()
+    for rid, river in enumerate(wg.rivers, 1):
+        for (x0, y0), (x1, y1) in zip(river.coords, river.coords[1:]):
+            d = md.flow_dir[y0, x0]
+            assert (x1, y1) == (x0 + dirx[d], y0 + diry[d])
+            assert md.river_id[y0, x0] == rid
+            if md.river_id[y1, x1] == rid:
+                assert md.river_length[y1, x1] > md.river_length[y0, x0]
+
+
+def test_node_grid_nearest_matches_brute_force():
+    rng = np.random.RandomState(0)
+    grid = worldgen.NodeGrid(cell_size=8)
+    assert grid.nearest(0, 0) is None
+    nodes = []
+    for x, y in rng.randint(-100, 100, (300, 2)).tolist():
+        grid.add(x, y)
+        nodes.append((x, y))
+        qx, qy = rng.randint(-150, 150, 2).tolist()
+        nx, ny = grid.nearest(qx, qy)
+        best = min((tx - qx) ** 2 + (ty - qy) ** 2 for tx, ty in nodes)
+        assert (nx - qx) ** 2 + (ny - qy) ** 2 == best
+
+
+def test_drainage_area_grows_downstream():
+    wg = WorldGenerator(128, 128, seed=3)
+    for stage in worldgen.STAGES[:5]:
+        stage.run(wg)
+    md = wg.map_data
+    assert md.area.min() >= 0.0
+    receiver = worldgen.downstream_index(md.flow_dir)
+    moving = (md.flow_dir != 0).ravel()
+    area = md.area.ravel()
+    assert (area[receiver[moving]] >= area[moving]).all()
+
+
+def test_generated_rivers_reach_the_sea():
+    wg = WorldGenerator(128, 128, seed=1)
+    wg.generate()
+    md = wg.map_data
+    land = wg._hm >= SAND_HEIGHT
+    # Follow every cell's drainage to its end by pointer jumping
+    end = worldgen.downstream_index(md.flow_dir)
+    for _ in range(20):
+        end = end[end]
+    ends = np.zeros(land.shape, bool)
+    ends[1:-1, 1:-1] = True
+    assert not (land & ends).ravel()[end].any()  # No inland pits
+    lengths = np.array([len(river.coords) for river in wg.rivers])
+    assert len(lengths) > 10 and (lengths == 1).mean() < 0.05
+    assert (end[end] == end).all()
+    # This world is an island: nearly all of its land drains into the sea
+    assert (~land.ravel()[end])[land.ravel()].mean() > 0.9
+
+
+def test_generate_river_trees():
+    wg = make_world(64, 64)
+    wg._hm[:, :8] = SAND_HEIGHT - 0.01
+    wg.generate_river_trees(count=3)
+    river = wg.map_data.river_id > 0
+    assert river.any() and set(np.unique(wg.map_data.river_id[river])) <= {1, 2, 3}
+    assert (wg._hm[river] >= SAND_HEIGHT).all()
+    assert (wg._precipitation[river] == 1.0).all()
+
+
+WORLD_DIGEST_SCRIPT = """
+import hashlib, worldgen
+wg = worldgen.WorldGenerator(64, 48, seed=7, hill_cnt=40)
+wg.generate()
+digest = hashlib.sha256()
+for arr in [wg._hm, wg._hm2, wg._precipitation, wg._hm_temperature, wg._biome_map, wg._clouds,
+            wg.map_data.river_id] + [wg._colors[view] for view in worldgen.color_views]:
+    digest.update(arr.tobytes())
+print(digest.hexdigest())
+"""
+
+
+def test_generation_is_reproducible():
+    import subprocess
+    import sys
+    digests = [subprocess.run([sys.executable, '-c', WORLD_DIGEST_SCRIPT], check=True,
+                              capture_output=True, text=True).stdout.split()[-1]
+               for _ in range(2)]
+    assert digests[0] == digests[1]
+    wg = WorldGenerator(64, 48, seed=7)
+    assert wg.rng('colors').random() == WorldGenerator(64, 48, seed=7).rng('colors').random()
+    assert wg.rng('colors').random() != wg.rng('base_map').random()
+
+
+def test_seeds_like_random_random():
+    def draw(*args, **kwargs):
+        return WorldGenerator(16, 16, *args, **kwargs).rng('colors').random()
+    for seed in ('islands', b'islands', -7):
+        assert draw(seed=seed) == draw(seed=seed)
+    assert len({draw(seed=s) for s in ('islands', -7, 7, 'other')}) == 4
+    assert draw(0.01, 0.9, 0.01, 0.4, 42) == draw(seed=42)  # Positional seed
+    assert WorldGenerator(16, 16, seed=3).random.random() == \
+        WorldGenerator(16, 16, seed=3).random.random()
+
+
+def test_cloud_layer_scrolls_like_regenerating():
+    wg = WorldGenerator(40, 30, seed=3)
+    wg.build_base_map(20)
+    layer = wg.clouds
+    for dx in (0.6, 0.7, 3.2, 55.0):
+        wg.update_clouds(dx / 5)
+        xs = np.arange(40) + layer.offset
+        expected = worldgen.cloud_layer(wg.noise2d, xs, np.arange(30), 40, 30)
+        assert np.allclose(wg._clouds, expected)
+    xs, ys = np.array([0.0, 3.3, 38.9]), np.array([[0.0], [12.5], [29.0]])
+    assert np.allclose(wg.cloud_thickness(xs, ys),
+                       worldgen.interpolate_bilinear(wg._clouds, xs + layer.dx, ys), atol=1e-6)
+    with pytest.raises(ValueError):
+        wg._clouds[0, 0] = 5.0  # A snapshot: writes would be lost
+    wg._clouds = np.full((30, 40), 0.5, np.float32)
+    assert (wg._clouds == 0.5).all()
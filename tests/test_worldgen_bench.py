@@ -0,0 +1,29 @@
+import json
+import worldgen
+from worldgen_bench import benchmark, main, scaling_exponents
+
+
+def test_scaling_exponents():
+    exponents = scaling_exponents([10, 20, 40], {'linear': [1.0, 4.0, 16.0],
+                                                 'quadratic': [1.0, 16.0, 256.0]})
+    assert abs(exponents['linear'] - 1.0) < 1e-9
+    assert abs(exponents['quadratic'] - 2.0) < 1e-9
+
+
+def test_benchmark_records_every_stage():
+    results = benchmark(sizes=(32, 48), repeat=1)
+    assert list(results['stages']) == [stage.name for stage in worldgen.STAGES]
+    for data in results['stages'].values():
+        assert len(data['seconds']) == len(data['peak_bytes']) == 2
+        assert all(t >= 0 for t in data['seconds']) and data['exponent'] is not None
+    assert results['stages']['erosion']['peak_bytes'][1] > 0
+    assert set(results['superlinear']) <= set(results['stages'])
+
+
+def test_cli_writes_json(tmp_path, capsys):
+    path = str(tmp_path / 'bench.json')
+    assert main(['--sizes', '32', '--repeat', '1', '--no-memory', '--output', path]) == 0
+    with open(path) as f:
+        results = json.load(f)
+    assert results['sizes'] == [32] and results['stages']['colors']['peak_bytes'] is None
+    assert 'base_map' in capsys.readouterr().out
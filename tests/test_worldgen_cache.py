@@ -0,0 +1,40 @@
+import os
+import time
+import numpy as np
+import worldgen
+from worldgen_cache import WorldCache, world_key
+
+
+def test_cache_round_trip(tmp_path, make_world):
+    cache = WorldCache(str(tmp_path))
+    wg = cache.generate(make_world())
+    loaded = make_world()
+    assert cache.load(loaded)
+    for name in ('_hm', '_hm2', '_precipitation', '_hm_temperature', '_biome_map'):
+        assert np.array_equal(getattr(loaded, name), getattr(wg, name))
+        assert getattr(loaded, name).dtype == getattr(wg, name).dtype
+    for view in worldgen.color_views:
+        assert np.array_equal(loaded._colors[view], wg._colors[view])
+    assert loaded.rivers == wg.rivers
+    loaded._hm[0, 0] = 5.0  # Copy on write: the cache is untouched
+    again = make_world()
+    assert cache.load(again) and again._hm[0, 0] == wg._hm[0, 0]
+
+
+def test_cache_keys(make_world):
+    assert world_key(make_world()) == world_key(make_world())
+    assert world_key(make_world()) != world_key(make_world(seed=4))
+    assert world_key(make_world()) != world_key(make_world(erosion_factor=0.02))
+    assert world_key(make_world(seed=None)) is None
+
+
+def test_cache_evicts_least_recently_used(tmp_path, make_world):
+    cache = WorldCache(str(tmp_path))
+    for seed in (1, 2):
+        cache.generate(make_world(seed))
+    size = max(size for _, size, _ in cache.entries())
+    os.utime(cache.entry_path(world_key(make_world(1))), (time.time() + 10,) * 2)
+    cache.max_bytes = 2 * size
+    cache.generate(make_world(3))
+    assert {os.path.basename(p) for _, _, p in cache.entries()} == {
+        world_key(make_world(1)), world_key(make_world(3))}
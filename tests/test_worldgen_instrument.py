@@ -0,0 +1,43 @@
+import json
+import logging
+import worldgen
+from worldgen_instrument import ChromeTrace, Instrument, LogObserver, Observer, Profiler
+from worldgen_pipeline import Pipeline
+
+
+class Recorder(Observer):
+    def __init__(self):
+        self.events = []
+
+    def stage_start(self, event):
+        self.events.append(event)
+
+    stage_progress = stage_end = stage_start
+
+
+def test_instrument_events(make_world):
+    wg = make_world()
+    recorder = Recorder()
+    wg.generate(progress=Instrument(wg, recorder))
+    ends = [e for e in recorder.events if e.status == 'done']
+    assert [e.stage for e in ends] == [stage.name for stage in worldgen.STAGES]
+    assert all(e.wall >= 0 and e.cpu >= 0 for e in ends)
+    assert ends[-1].memory == sum(wg._colors[view].nbytes for view in worldgen.color_views)
+    erosion = [e.fraction for e in recorder.events
+               if e.stage == 'erosion' and e.status == 'progress']
+    assert erosion == sorted(erosion) and len(erosion) == 4 and 0 < erosion[-1] < 1
+
+
+def test_sinks(tmp_path, caplog, make_world):
+    wg = make_world()
+    trace, profiler = ChromeTrace(), Profiler()
+    with caplog.at_level(logging.INFO, logger='worldgen_instrument'):
+        Pipeline(str(tmp_path)).run(wg, progress=Instrument(wg, LogObserver(), trace, profiler))
+    assert 'erosion done in' in caplog.text
+    assert 'erode' in profiler.report('erosion')
+    path = str(tmp_path / 'trace.json')
+    trace.save(path)
+    with open(path) as f:
+        events = json.load(f)['traceEvents']
+    assert [e['name'] for e in events if e['ph'] == 'X'] == [s.name for s in worldgen.STAGES]
+    assert any(e['ph'] == 'C' for e in events)
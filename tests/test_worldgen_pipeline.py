@@ -0,0 +1,57 @@
+import os
+import numpy as np
+import worldgen
+from worldgen import WorldGenerator
+import worldgen_pipeline
+from worldgen_pipeline import Pipeline
+
+
+def run(path, events=None, **kwargs):
+    wg = WorldGenerator(64, 48, seed=2, hill_cnt=40, **kwargs)
+    progress = None if events is None else events.append
+    return Pipeline(str(path)).run(wg, progress)
+
+
+def same_world(a, b):
+    return (np.array_equal(a._hm, b._hm) and np.array_equal(a._biome_map, b._biome_map)
+            and np.array_equal(a.map_data.river_id, b.map_data.river_id)
+            and a.rivers == b.rivers
+            and all(np.array_equal(a._colors[v], b._colors[v]) for v in worldgen.color_views))
+
+
+def test_pipeline_matches_generate(tmp_path):
+    wg = WorldGenerator(64, 48, seed=2, hill_cnt=40)
+    events = []
+    wg.generate(progress=events.append)
+    stages = [e.status for e in events if e.status != 'progress']
+    assert stages == ['start', 'done'] * len(worldgen.STAGES)
+    assert all(0 < e.fraction < 1 for e in events if e.status == 'progress')
+    assert same_world(run(tmp_path), wg)
+
+
+def test_pipeline_reruns_stages_after_changed_parameter(tmp_path):
+    run(tmp_path)
+    events = []
+    changed = run(tmp_path, events, erosion_factor=0.02)
+    loaded = [e.stage for e in events if e.status == 'loaded']
+    assert loaded == ['base_map', 'precipitation']
+    assert same_world(changed, run(tmp_path / 'fresh', erosion_factor=0.02))
+
+
+def test_pipeline_resumes_after_crash(tmp_path):
+    expected = run(tmp_path)
+    for name in sorted(os.listdir(tmp_path))[4:]:
+        os.remove(os.path.join(tmp_path, name))
+    events = []
+    resumed = run(tmp_path, events)
+    assert [e.status for e in events[:4]] == ['loaded'] * 4
+    assert events[4].status == 'start' and events[4].stage == 'rivers'
+    assert same_world(resumed, expected)
+
+
+def test_pipeline_reruns_everything_after_code_change(tmp_path, monkeypatch):
+    run(tmp_path)
+    monkeypatch.setattr(worldgen_pipeline, 'code_version', lambda: 'edited')
+    events = []
+    run(tmp_path, events)
+    assert not [e for e in events if e.status == 'loaded']
@@ -0,0 +1,43 @@
+import numpy as np
+import worldgen
+from worldgen import WorldGenerator
+from worldgen_pyramid import WorldPyramid, downsample, mean_pool, mode_pool
+
+
+def test_mean_pool():
+    arr = np.arange(15, dtype=np.float32).reshape(3, 5)
+    pooled = mean_pool(arr)
+    assert pooled.shape == (2, 3) and pooled.dtype == np.float32
+    assert pooled[0, 0] == (0 + 1 + 5 + 6) / 4
+    assert pooled[1, 2] == 14  # Odd corner repeats its edge
+    colors = np.array([[[0, 0, 0], [255, 255, 1]]] * 2, np.uint8)
+    assert mean_pool(colors).tolist() == [[[128, 128, 0]]]
+
+
+def test_mode_pool():
+    arr = np.array([[1, 2, 3, 3],
+                    [2, 2, 4, 5],
+                    [7, 8, 9, 9]], np.uint8)
+    assert mode_pool(arr).tolist() == [[2, 3], [7, 9]]
+
+
+def test_downsample_in_bands():
+    arr = np.random.default_rng(0).random((37, 21)).astype(np.float32)
+    assert np.array_equal(downsample(arr, mean_pool, band=6), mean_pool(arr))
+
+
+def test_pyramid():
+    wg = WorldGenerator(96, 80, seed=5, hill_cnt=60)
+    wg.generate()
+    pyramid = WorldPyramid.build(wg, min_size=16)
+    assert [pyramid.shape(k) for k in range(len(pyramid.levels))] == [
+        (80, 96), (40, 48), (20, 24), (10, 12)]
+    assert pyramid.levels[0]['height'] is wg._hm
+    assert set(pyramid.levels[3]) == {'height', 'precipitation', 'temperature', 'biome'} | {
+        'colors.' + view for view in worldgen.color_views}
+    assert pyramid.levels[1]['biome'].dtype == np.uint8
+    assert np.isin(pyramid.levels[2]['biome'], wg._biome_map).all()
+    assert pyramid.rect('height', 8, 4, 40, 20, 2).shape == (4, 8)
+    assert np.array_equal(pyramid.rect('colors.land', 0, 0, 96, 80, 0), wg._colors['land'])
+    assert pyramid.rect('height', 90, 70, 200, 200, 1).shape == (5, 3)
+    assert [pyramid.level_for_scale(s) for s in (0.5, 1, 3, 4, 100)] == [0, 0, 1, 2, 3]
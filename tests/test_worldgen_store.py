@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+from worldgen import WorldGenerator
+from worldgen_pipeline import get_value
+from worldgen_store import WorldStore, layers
+from worldgen_tiled import generate_tiled
+
+
+def test_layers_match_generator(make_world):
+    wg = make_world()
+    wg.compute_colors()
+    for name, dtype, shape in layers(wg.width, wg.height):
+        arr = get_value(wg, name)
+        assert arr.dtype == dtype and arr.shape == shape, name
+
+
+def test_store_round_trip(tmp_path, make_world):
+    expected = make_world()
+    expected.generate()
+    store = WorldStore.create(str(tmp_path), make_world())
+    store.generate()
+    wg = WorldStore.open(str(tmp_path)).world()
+    assert wg.seed == 3 and wg.rivers == expected.rivers
+    for name, _, _ in layers(wg.width, wg.height):
+        arr = get_value(wg, name)
+        assert isinstance(arr, np.memmap), name
+        assert np.array_equal(arr, get_value(expected, name)), name
+    with pytest.raises(ValueError):
+        wg._hm[0, 0] = 1.0
+    wg.update_clouds(3)  # Copy on write
+    assert np.array_equal(WorldStore.open(str(tmp_path)).world()._clouds, expected._clouds)
+
+
+def test_store_bytes_seed(tmp_path, make_world):
+    store = WorldStore.create(str(tmp_path), make_world(b'world'))
+    store.generate()
+    wg = WorldStore.open(str(tmp_path)).world()
+    expected = make_world(b'world')
+    expected.generate()
+    assert np.array_equal(wg._hm, expected._hm) and wg.rivers == expected.rivers
+    regenerated = WorldGenerator(**store.header['settings'])
+    regenerated.generate()
+    assert np.array_equal(regenerated._hm, expected._hm)
+
+
+def test_store_tiled_generation(tmp_path, make_world):
+    expected = generate_tiled(make_world(), tile_size=16, workers=0)
+    store = WorldStore.create(str(tmp_path), make_world())
+    generate_tiled(store.wg, tile_size=16, workers=0)
+    store.flush()
+    wg = WorldStore.open(str(tmp_path)).world()
+    for name, _, _ in layers(wg.width, wg.height):
+        assert np.array_equal(get_value(wg, name), get_value(expected, name)), name
+    assert wg.rivers == expected.rivers
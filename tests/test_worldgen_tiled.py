@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+import worldgen
+import worldgen_tiled
+from worldgen_tiled import generate_tiled, tile_rects, window
+
+large_world = pytest.mark.parametrize(
+    'make_world', [dict(width=96, height=80, seed=5, hill_cnt=60)], indirect=True)
+
+
+def test_tiles_cover_map():
+    cover = np.zeros((80, 96), int)
+    for x0, y0, x1, y1 in tile_rects(96, 80, 32):
+        cover[y0:y1, x0:x1] += 1
+        win, core = window((x0, y0, x1, y1), 5, cover.shape)
+        assert cover[win][core].shape == (y1 - y0, x1 - x0)
+    assert (cover == 1).all()
+
+
+@large_world
+def test_tiled_generation_matches_generate(make_world):
+    expected = make_world()
+    expected.generate()
+    events = []
+    for workers in (0, 2):
+        wg = generate_tiled(make_world(), tile_size=32, workers=workers, erosion_halo=96,
+                            progress=events.append)
+        for name in ('_hm', '_hm2', '_clouds', '_precipitation', '_hm_temperature', '_biome_map'):
+            assert np.array_equal(getattr(wg, name), getattr(expected, name)), name
+        for name, _ in worldgen.MapDataGrid.fields:
+            assert np.array_equal(getattr(wg.map_data, name), getattr(expected.map_data, name))
+        assert wg.rivers == expected.rivers
+        for view in worldgen.color_views[:-1]:
+            assert np.array_equal(wg._colors[view], expected._colors[view])
+    assert [e.status for e in events] == ['start', 'done'] * 2 * len(worldgen.STAGES)
+
+
+@large_world
+def test_tiled_erosion_with_small_halo_is_close(make_world):
+    expected = make_world()
+    expected.generate()
+    wg = generate_tiled(make_world(), tile_size=32, workers=0, erosion_halo=8)
+    assert np.abs(wg._hm - expected._hm).mean() < 0.01
+
+
+@large_world
+def test_failed_tile_task_leaves_generator_usable(monkeypatch, make_world):
+
+    def fail(arrays, rect):
+        raise RuntimeError('tile failed')
+
+    monkeypatch.setattr(worldgen_tiled, '_climate_task', fail)
+    wg = make_world()
+    with pytest.raises(RuntimeError):
+        generate_tiled(wg, tile_size=32, workers=0)
+    # The shared memory is closed; the generator must not point into it
+    assert wg._hm.sum() > 0 and wg._precipitation.max() > 0
+    assert wg.map_data.area.max() > 0
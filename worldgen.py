@@ -1,19 +1,17 @@
 # A direct translation of Jice's worldgen tool.
+import hashlib
 import math
+import zlib
 import numpy as np
 import random
 import tcod
 import attr
 from tcod import Color
-from tcod.noise import Noise
-from itertools import count
-from collections import namedtuple
+import tcod.los
+import tcod.noise
 from enum import Enum
-from numba import jit, jitclass
-from numba import int32, float32, void
+import worldgen_kernels as kernels
 
-noise1d = tcod.noise_new(1)  # noise.NoiseGenerator(1)
-noise2d = tcod.noise_new(2)  # noise.NoiseGenerator(2)
 
 # Height and Biome Constants
 # --------------------------
@@ -26,6 +24,10 @@ class Climate(Enum):
     tropical = 4
 
 
+# Upper temperature bound (inclusive) of each climate but the last, in degC
+climate_bounds = [-5, 5, 15, 20]
+
+
 def get_climate_from_temp(temperature):
     if temperature <= -5:
         return Climate.arctic_alpine
@@ -77,9 +79,21 @@ biome_colors = {
     Biome.temperate_deciduous_forest: Color(180, 201, 169),
     Biome.tropical_rain_forest: Color(156, 187, 169),
     Biome.tropical_seasonal_forest: Color(169, 204, 164),
-    Biome.subtropical_desert: Color(233, 221, 199)
+    Biome.subtropical_desert: Color(233, 221, 199),
+    Biome.tropical_mountain_forest: Color(164, 196, 168),
+    Biome.cold_desert: Color(228, 232, 202),
+    Biome.boreal_forest: Color(204, 212, 187),
+    Biome.hot_desert: Color(233, 221, 199),
+    Biome.savanna: Color(211, 214, 160),
+    Biome.tropical_dry_forest: Color(169, 204, 164),
+    Biome.tropical_evergreen_forest: Color(156, 187, 169),
+    Biome.thorn_forest: Color(196, 204, 160),
+    Biome.temperate_forest: Color(180, 201, 169)
 }
 
+# biome_colors as a Biome value -> RGB lookup table
+biome_rgb = np.array([tuple(biome_colors[biome]) for biome in Biome], np.uint8)
+
 biome_diagram = [
     # artic/alpine climate (below -5degC)
     [Biome.tundra, Biome.tundra, Biome.tundra, Biome.tundra, Biome.tundra],
@@ -105,11 +119,24 @@ biome_diagram = [
     ]
 ]
 
+# biome_diagram as a (climate, humidity) -> Biome value lookup table
+biome_table = np.array([[biome.value for biome in row] for row in biome_diagram], np.uint8)
+
 SAND_HEIGHT = 0.12
 GRASS_HEIGHT = 0.16  # 0.315f;
 ROCK_HEIGHT = 0.655
 SNOW_HEIGHT = 0.905  # 0.785f;
 
+# Base map: hills of radius HILL_RADIUS * width (+/- HILL_RADIUS_VAR) and height
+# HILL_HEIGHT, plus fBm noise of frequency FBM_FREQUENCY * width
+HILL_RADIUS, HILL_RADIUS_VAR, HILL_HEIGHT = 16 / 200, 0.7, 0.6
+FBM_FREQUENCY, FBM_OCTAVES, FBM_DELTA, FBM_SCALE = 2.2 / 400, 10, 1.0, 2.05
+
+# 3x3 kernel for smoothing operations
+SMOOTH_DX = [-1, 0, 1, -1, 0, 1, -1, 0, 1]
+SMOOTH_DY = [-1, -1, -1, 0, 0, 0, 1, 1, 1]
+SMOOTH_WEIGHT = [2, 8, 2, 8, 20, 8, 2, 8, 2]
+
 # TCOD's land color map
 # ---------------------
 
@@ -215,6 +242,91 @@ tempKeyrgb_color_int = [
     (80, 3, 0)
 ]  # 30 degC
 
+# Color ramps
+# -----------
+
+
+def color_ramp(indexes, colors):
+    """Build a 256-entry RGB lookup table from key `colors` placed at `indexes`.
+
+    Same as tcod.color_gen_map, as a (256, 3) uint8 array: like it, the
+    entries outside [indexes[0], indexes[-1]] are left black.
+    """
+    colors = np.asarray(colors, np.float64)
+    ramp = [np.interp(np.arange(256), indexes, colors[:, c]) for c in range(3)]
+    ramp = np.stack(ramp, axis=-1).astype(np.uint8)
+    ramp[:indexes[0]] = 0
+    ramp[indexes[-1] + 1:] = 0
+    return ramp
+
+
+land_ramp = color_ramp(keyIndex, keyrgb_color_int)
+altitude_ramp = color_ramp(altIndexes, altrgb_color_ints)
+precipitation_ramp = color_ramp(precIndexes, precrgb_color_ints)
+temperature_ramp = color_ramp(tempIndexes, tempKeyrgb_color_int)
+
+
+def ramp_index(values):
+    "Map values in [0, 1] to indexes into a 256-entry color ramp."
+    return np.clip((256 * np.asarray(values)).astype(np.intp), 0, 255)
+
+
+# Climate and colors
+# ------------------
+
+
+def temperatures_and_biomes(hm, precip, rows, height):
+    """Temperature and biome of each cell of `hm` and `precip`.
+
+    `rows` holds the row of the map, `height` rows high, of each row of the
+    arrays; it sets their latitude.
+    """
+    sand_coef = 1.0 / (1.0 - SAND_HEIGHT)
+    water_coef = 1.0 / SAND_HEIGHT
+    lat = (rows - height / 2) * 2 / height
+    lat_temp = 0.5 * (1.0 + np.sin(math.pi * (lat + 0.5)) ** 5)
+    lat_temp = -30 + np.sqrt(lat_temp) * 60
+    h = hm - SAND_HEIGHT
+    h = np.where(h < 0.0, h * water_coef, h * sand_coef)
+    temperature = lat_temp[:, None] + h * -35
+    climate = np.digitize(temperature, climate_bounds, right=True)
+    i_humid = np.clip(np.rint(precip * 5), 0, 4).astype(np.intp)
+    return temperature, biome_table[climate, i_humid]
+
+
+def blend_biome_colors(biome_map, rng, samples=4, spread=10, jitter=10):
+    """Color each cell by averaging its biome color with `samples` random nearby cells.
+
+    Neighbours are picked up to `spread` cells away and their colors are
+    jittered by up to `jitter`, all drawn from the numpy generator `rng`.
+    """
+    height, width = biome_map.shape
+    ys, xs = np.mgrid[0:height, 0:width]
+    total = biome_rgb[biome_map].astype(np.int32)
+    count = np.ones(biome_map.shape, np.int32)
+    for _ in range(samples):
+        ix = xs + rng.integers(-spread, spread + 1, xs.shape)
+        iy = ys + rng.integers(-spread, spread + 1, ys.shape)
+        inside = (ix >= 0) & (ix < width) & (iy >= 0) & (iy < height)
+        c = biome_rgb[biome_map[iy.clip(0, height - 1), ix.clip(0, width - 1)]]
+        c = c + rng.integers(-jitter, jitter + 1, c.shape)
+        total += np.where(inside[..., None], c, 0)
+        count += inside
+    return np.clip(total / count[..., None], 0, 255).astype(np.uint8)
+
+
+def colorize(hm, precip, temperature, biome_map, rng):
+    "The land, altitude, precipitation, temperature and biome views, as RGB images."
+    temp_index = np.interp(temperature, temperatures, tempIndexes).astype(np.intp)
+    return {
+        'land': land_ramp[ramp_index(hm)],
+        'altitude': altitude_ramp[ramp_index(hm)],
+        'precipitation': precipitation_ramp[ramp_index(precip)],
+        'temperature': temperature_ramp[temp_index],
+        'biome': blend_biome_colors(biome_map, rng),
+    }
+
+
 # What are these? They appear just before erode_map
 # ---------------
 
@@ -226,17 +338,17 @@ dircoef = [
 oppdir = [0, 8, 7, 6, 5, 4, 3, 2, 1]
 
 
-@jit
+@kernels.kernel
 def in_rectangle(x: float, y: float, w: float, h: float) -> bool:
     return (x < w) and (y < h)
 
 
-@jit
+@kernels.kernel
 def sqrdist(x1: float, y1: float, x2: float, y2: float) -> float:
     return (((x1) - (x2)) * ((x1) - (x2)) + ((y1) - (y2)) * ((y1) - (y2)))
 
 
-@jit
+@kernels.kernel
 def clamp(cmin: float, cmax: float, val: float) -> float:
     if cmin > val:
         return cmin
@@ -274,32 +386,560 @@ def get_interpolated_float(arr, x, y, width, height):
     return (1.0 - dy) * iN + dy * iS
 
 
-@jit(nopython=True)
-def new_heightmap(w: int, h:int) -> np.ndarray:
-    return np.zeros((h, w), np.float32) # , order="C")
-
-spec = [
-    ('slope', float32),
-    ('area', float32),
-    ('flow_dir', float32),
-    ('up_dir', int32),
-    ('in_flags', int32),
-    ('river_id', int32),
-    ('river_length', float32),
-    ('__hash__', void),
-    ('__annotations__', void),
-    ('__attrs_attrs__', void)
-]
+def sample_noise(noise, coords, octaves=None, noise_type=tcod.NOISE_SIMPLEX):
+    """Sample a tcod noise generator over whole coordinate arrays in one call.
+
+    `coords` holds one array per noise dimension; they are broadcast against
+    each other, so open grids such as (xs[None, :], ys[:, None]) give a full
+    (height, width) field. With `octaves` the samples are fBm, like
+    tcod.noise_get_fbm, otherwise plain noise like tcod.noise_get.
+    """
+    grid = np.stack(np.broadcast_arrays(*coords)).astype(np.float32)
+    saved = noise.algorithm, noise.implementation, noise.octaves
+    noise.algorithm = noise_type
+    if octaves is None:
+        noise.implementation = tcod.noise.Implementation.SIMPLE
+    else:
+        noise.implementation = tcod.noise.Implementation.FBM
+        noise.octaves = octaves
+    try:
+        return noise.sample_mgrid(grid).astype(np.float32)
+    finally:
+        noise.algorithm, noise.implementation, noise.octaves = saved
+
+
+def seed_entropy(seed):
+    """The non-negative integer entropy of a world seed, for numpy.random.SeedSequence.
+
+    Like random.Random, strings, bytes and negative integers are accepted:
+    they are hashed with SHA-256. None stays None, for fresh OS entropy.
+    """
+    if seed is None or (isinstance(seed, int) and seed >= 0):
+        return seed
+    if isinstance(seed, str):
+        seed = seed.encode()
+    elif isinstance(seed, int):
+        seed = str(seed).encode()
+    return int.from_bytes(hashlib.sha256(seed).digest(), 'big')
+
+
+def noise_seed(seed_seq):
+    "The integer tcod noise seed drawn from the numpy SeedSequence `seed_seq`."
+    return int(seed_seq.generate_state(1)[0])
+
+
+def make_noise(dimensions, seed_seq):
+    "A tcod noise generator seeded from the numpy SeedSequence `seed_seq`."
+    return tcod.noise.Noise(dimensions, seed=noise_seed(seed_seq))
+
+
+def fbm_layer(noise, xs, ys, width, height, mul, octaves, delta, scale):
+    """The fBm noise heightmap_add_fbm adds to the cells at columns `xs` and rows `ys`.
+
+    `width` and `height` are those of the whole map, so that any window of it
+    can be computed on its own.
+    """
+    fx, fy = xs * (mul / width), ys * (mul / height)
+    return delta + sample_noise(noise, (fx[None, :], fy[:, None]), octaves) * scale
+
+
+def cloud_layer(noise, xs, ys, width, height):
+    "Cloud thickness of the cells at (fractional) columns `xs` and rows `ys` of the map."
+    fx, fy = 6.0 * xs / width, 6.0 * ys / height
+    return 0.5 * (1.0 + 0.8 * sample_noise(noise, (fx[None, :], fy[:, None]), 4.0))
+
+
+def smooth(hm):
+    """Smooth `hm` in place with the SMOOTH_WEIGHT 3x3 kernel.
+
+    Unlike tcod.heightmap_kernel_transform, which reads the cells it already
+    smoothed, every cell is computed from the original map, so any window of
+    the map smooths the same given a one cell border.
+    """
+    values = np.pad(hm.astype(np.float64), 1)
+    inside = np.pad(np.ones(hm.shape), 1)
+    height, width = hm.shape
+    total, weight = np.zeros(hm.shape), np.zeros(hm.shape)
+    for dx, dy, w in zip(SMOOTH_DX, SMOOTH_DY, SMOOTH_WEIGHT):
+        window = (slice(1 + dy, 1 + dy + height), slice(1 + dx, 1 + dx + width))
+        total += w * values[window]
+        weight += w * inside[window]
+    hm[:] = total / weight
+
+
+def new_heightmap(w: int, h: int) -> np.ndarray:
+    return np.zeros((h, w), np.float32)
+
+
+# Array-based erosion engine
+# --------------------------
+#
+# The passes below replace the per-cell loops that erode_map used to run. All of
+# them work on (height, width) float32 heightmaps. Unlike the old loops, every
+# one of the eight neighbours is considered and neighbours never wrap across the
+# map edges.
+
+_dirx = np.array(dirx, np.intp)
+_diry = np.array(diry, np.intp)
+_dircoef = np.array(dircoef, np.float32)
+_oppdir = np.array(oppdir, np.intp)
+_diagonal = [False, True, False, True, False, False, True, False, True]
+
+
+def neighbours(arr, fill):
+    """Return views of `arr` shifted towards each direction of dirx/diry.
+
+    The i-th view holds, at [y, x], the value of the neighbour at
+    (x + dirx[i], y + diry[i]), or `fill` where that neighbour is off the map.
+    """
+    h, w = arr.shape
+    padded = np.pad(arr, 1, mode='constant', constant_values=fill)
+    return [padded[1 + dy:1 + dy + h, 1 + dx:1 + dx + w] for dx, dy in zip(dirx, diry)]
+
+
+def flow_directions(hm):
+    """Compute the flow direction, up direction and slope of every cell of `hm`.
+
+    Directions index into dirx/diry, 0 meaning the cell is a pit (or a peak for
+    the up direction). Ties go to the first direction in dirx/diry order.
+    """
+    hmin, hmax = hm, hm
+    flow_dir = np.zeros(hm.shape, np.int8)
+    up_dir = np.zeros(hm.shape, np.int8)
+    below, above = neighbours(hm, np.inf), neighbours(hm, -np.inf)
+    for i in range(1, 9):
+        lower = below[i] < hmin
+        higher = ~lower & (above[i] > hmax)
+        hmin = np.where(lower, below[i], hmin)
+        flow_dir = np.where(lower, np.int8(i), flow_dir)
+        hmax = np.where(higher, above[i], hmax)
+        up_dir = np.where(higher, np.int8(i), up_dir)
+    slope = (hmin - hm) * _dircoef[flow_dir]
+    return flow_dir, up_dir, slope.astype(np.float32)
+
+
+def downstream_index(flow_dir):
+    "Flat index of the cell each cell of `flow_dir` drains into (itself for pits)."
+    h, w = flow_dir.shape
+    idx = np.arange(h * w).reshape(h, w)
+    return (idx + _diry[flow_dir] * w + _dirx[flow_dir]).ravel()
+
+
+def drainage_directions(hm, sea_level):
+    """Flow directions of `hm` along which every cell drains to the sea or the map edge.
+
+    Depressions are filled by a priority flood from the cells below
+    `sea_level` and the map border (see kernels.priority_flood). Cells drain
+    along their steepest descent on the filled map, and cells left without
+    one, the pits and the flooded flats, towards the cell that flooded them,
+    which leads out through the spill point. Only the flood's seeds have
+    direction 0.
+    """
+    h, w = hm.shape
+    outlet = hm < sea_level
+    outlet[[0, -1], :] = True
+    outlet[:, [0, -1]] = True
+    filled, parent = kernels.priority_flood(hm, np.flatnonzero(outlet), _dirx, _diry, _oppdir)
+    flow_dir = flow_directions(filled)[0]
+    return np.where(flow_dir != 0, flow_dir, parent)
+
+
+def flow_slope(hm, flow_dir):
+    "Height difference from each cell of `hm` to the cell it drains into, per unit distance."
+    return ((hm.ravel()[downstream_index(flow_dir)].reshape(hm.shape) - hm)
+            * _dircoef[flow_dir]).astype(np.float32)
+
+
+def inflow_flags(flow_dir):
+    "Bit mask of the neighbours draining into each cell, bit i - 1 standing for direction i."
+    flags = np.zeros(flow_dir.shape, np.uint8)
+    for i, nflow in enumerate(neighbours(flow_dir, 0)):
+        if i > 0:
+            flags |= np.where(nflow == oppdir[i], np.uint8(1 << (i - 1)), np.uint8(0))
+    return flags
+
+
+def accumulate_flow(receiver, edge, local):
+    """Accumulate flow down a drainage graph, a batch of cells at a time.
+
+    `receiver[i]` is the cell that cell i drains into, followed only where
+    `edge[i]` is set. `local(ready, inflow)` returns the quantity leaving each
+    cell of `ready` given what flowed into it; it is called once per cell, after
+    every cell upstream of it. Returns the total inflow of every cell.
+    """
+    n = receiver.size
+    inflow = np.zeros(n)
+    indeg = np.bincount(receiver[edge], minlength=n)
+    slot = np.zeros(n, np.intp)
+    ready = np.flatnonzero(indeg == 0)
+    while ready.size:
+        out = local(ready, inflow[ready])
+        src = edge[ready]
+        dst = receiver[ready[src]]
+        np.add.at(inflow, dst, out[src])
+        np.subtract.at(indeg, dst, 1)
+        # Keep a single copy of the cells whose last donor was just processed
+        dst = dst[indeg[dst] == 0]
+        order = np.arange(dst.size)
+        slot[dst] = order
+        ready = dst[slot[dst] == order]
+    return inflow
+
+
+def erosion_pass(hm, precip, flow_dir, slope, erosion_factor, sedimentation_factor):
+    """Erode `hm` along every flow path and deposit the sediment in the pits.
+
+    This is equivalent to walking downstream from each land cell, eroding every
+    cell on the way by `precip * erosion_factor * slope` and dropping the
+    collected sediment in the pit the walk ends in, except that all the walks
+    are traced together by counting how many of them cross each cell.
+    """
+    land = (hm >= SAND_HEIGHT - 0.01).ravel()
+    pit = (flow_dir == 0).ravel()
+    receiver = downstream_index(flow_dir)
+    edge = land & ~pit & land[receiver]
+    drop = -slope.ravel().astype(np.float64)
+    count = np.ones(receiver.size)
+    sediment = np.zeros(receiver.size)
+
+    def walks(ready, inflow_count):
+        count[ready] += inflow_count
+        return count[ready]
+
+    def carried(ready, inflow_sediment):
+        sediment[ready] = inflow_sediment
+        return inflow_sediment + count[ready] * drop[ready]
+
+    accumulate_flow(receiver, edge, walks)
+    accumulate_flow(receiver, edge, carried)
+    count, sediment = count.reshape(hm.shape), sediment.reshape(hm.shape)
+    land, pit = land.reshape(hm.shape), pit.reshape(hm.shape)
+
+    eroded = np.maximum(hm + count * precip * erosion_factor * slope, SAND_HEIGHT)
+    filled = np.where(count > 1,
+                      np.maximum(hm, SAND_HEIGHT) + sedimentation_factor * sediment,
+                      hm)
+    out = np.where(pit, filled, eroded)
+    return np.where(land, out, hm).astype(np.float32)
+
+
+def erode(hm, precip, iterations, erosion_factor, sedimentation_factor, progress=None):
+    """Run `iterations` erosion passes over `hm`, given precipitations in cm.
+
+    Returns the eroded heightmap and the flow_directions of the last pass.
+    `progress`, if given, is called with the fraction of the passes done after each.
+    """
+    for i in range(iterations):
+        flow_dir, up_dir, slope = flow_directions(hm)
+        hm = erosion_pass(hm, precip, flow_dir, slope, erosion_factor, sedimentation_factor)
+        if progress is not None:
+            progress((i + 1) / (iterations + 1))
+    return hm, flow_dir, up_dir, slope
+
+
+def mudslide(hm, max_erosion_alt, mudslide_coef):
+    "Slide every land cell below `max_erosion_alt` towards its lower neighbours."
+    sum_delta1, sum_delta2 = np.zeros_like(hm), np.zeros_like(hm)
+    nb1, nb2 = np.ones_like(hm), np.ones_like(hm)
+    for i, ih in enumerate(neighbours(hm, np.inf)):
+        lower = ih < hm
+        delta = np.where(lower, ih - hm, 0.0)
+        if _diagonal[i]:
+            sum_delta1 += delta * 0.4
+            nb1 += lower
+        else:
+            sum_delta2 += delta * 1.6
+            nb2 += lower
+    dh = (sum_delta1 / nb1 + sum_delta2 / nb2) * mudslide_coef
+    hcoef = (hm - SAND_HEIGHT) / (1 - SAND_HEIGHT)
+    dh *= (1.0 - hcoef * hcoef * hcoef)  # Smoothing decrease as altitude increases
+    fixed = (hm < SAND_HEIGHT - 0.01) | (hm >= max_erosion_alt)
+    return np.where(fixed, hm, hm + dh).astype(np.float32)
+
+
+def flow_accumulation(flow_dir, weights):
+    "Total `weights` of the cells draining through each cell of `flow_dir`, itself included."
+    receiver = downstream_index(flow_dir)
+    edge = (flow_dir != 0).ravel()
+    weights = np.broadcast_to(np.asarray(weights, np.float64), flow_dir.shape).ravel()
+
+    def drained(ready, inflow):
+        return inflow + weights[ready]
+
+    area = accumulate_flow(receiver, edge, drained) + weights
+    return area.reshape(flow_dir.shape).astype(np.float32)
+
+
+def trace_rivers(flow_dir, area, land, min_area):
+    """Extract the land cells draining at least `min_area` as a river network.
+
+    Each river is traced from a source (a river cell no other river cell drains
+    into) down to the sea, a pit, or the river it flows into, whose cell ends
+    its polyline. Shared reaches belong to the river traced first. Returns the
+    list of River objects, the river id of each cell (0 for none, i + 1 for
+    rivers[i]) and the length of river upstream of each river cell.
+    """
+    receiver = downstream_index(flow_dir)
+    moving = (flow_dir != 0).ravel()
+    is_river = ((area >= min_area) & land).ravel()
+    fed = np.zeros(is_river.size, bool)
+    fed[receiver[is_river & moving]] = True
+    river_id = np.zeros(is_river.size, np.int32)
+    river_length = np.zeros(is_river.size, np.float32)
+    step = np.hypot(_dirx, _diry)
+    width = flow_dir.shape[1]
+    rivers = []
+    for i in np.flatnonzero(is_river & ~fed):
+        rid = len(rivers) + 1
+        length, path = 0.0, [i]
+        while True:
+            river_id[i], river_length[i] = rid, length
+            if not moving[i]:
+                break
+            length += step[flow_dir.flat[i]]
+            i = receiver[i]
+            path.append(i)
+            if not is_river[i] or river_id[i]:
+                break
+        coords = [(int(c % width), int(c // width)) for c in path]
+        rivers.append(River(coords, float(area.flat[path[-1]])))
+    shape = flow_dir.shape
+    return rivers, river_id.reshape(shape), river_length.reshape(shape)
+
+
+class NodeGrid(object):
+    """Points bucketed on a grid of `cell_size` cells, for nearest-node queries.
+
+    Adding a point is O(1); a query searches rings of buckets outwards from the
+    query point, clipped to the occupied buckets, and stops as soon as no
+    unsearched bucket can hold a closer point.
+    """
+
+    def __init__(self, cell_size=16):
+        self.cell_size = cell_size
+        self.buckets = {}
+        self.bounds = None  # min bx, min by, max bx, max by of the occupied buckets
+
+    def add(self, x, y):
+        key = bx, by = x // self.cell_size, y // self.cell_size
+        self.buckets.setdefault(key, []).append((x, y))
+        if self.bounds is None:
+            self.bounds = (bx, by, bx, by)
+        else:
+            x0, y0, x1, y1 = self.bounds
+            self.bounds = (min(x0, bx), min(y0, by), max(x1, bx), max(y1, by))
+
+    def nearest(self, x, y):
+        "Return the point closest to (x, y), or None if the grid is empty."
+        if self.bounds is None:
+            return None
+        x0, y0, x1, y1 = self.bounds
+        bx, by = x // self.cell_size, y // self.cell_size
+        # Rings closer than the occupied buckets are empty, the ones past them too
+        r = max(x0 - bx, bx - x1, y0 - by, by - y1, 0)
+        r_max = max(bx - x0, x1 - bx, by - y0, y1 - by)
+        best, best_dist = None, math.inf
+        while r <= r_max and (best is None or best_dist > (self.cell_size * (r - 1)) ** 2):
+            for key in self._ring(bx, by, r):
+                for (tx, ty) in self.buckets.get(key, ()):
+                    dist = (tx - x) * (tx - x) + (ty - y) * (ty - y)
+                    if dist < best_dist:
+                        best_dist, best = dist, (tx, ty)
+            r += 1
+        return best
+
+    def _ring(self, bx, by, r):
+        "Occupied-area bucket keys at Chebyshev distance `r` of (bx, by)."
+        x0, y0, x1, y1 = self.bounds
+        xs = range(max(bx - r, x0), min(bx + r, x1) + 1)
+        for ry in {by - r, by + r}:
+            if y0 <= ry <= y1:
+                for rx in xs:
+                    yield rx, ry
+        ys = range(max(by - r + 1, y0), min(by + r - 1, y1) + 1)
+        for rx in {bx - r, bx + r}:
+            if x0 <= rx <= x1:
+                for ry in ys:
+                    yield rx, ry
+
+
+def find_water_level(hm, land_mass, exact=False):
+    "Return the height below which a proportion 1 - `land_mass` of `hm` lies."
+    water_cnt = hm.size * (1.0 - land_mass)
+    if exact:
+        k = min(max(int(round(water_cnt)), 1), hm.size)
+        return float(np.partition(hm.ravel(), k - 1)[k - 1])
+    ih = np.minimum((np.maximum(hm, 0) * 255).astype(np.intp), 255)
+    heightcount = np.cumsum(np.bincount(ih.ravel(), minlength=256))
+    i = int(np.searchsorted(heightcount, water_cnt)) + 1 if water_cnt > 0 else 0
+    return i / 255.0
+
+
+def land_mass_remap(hm, land_mass, water_level, exact=False):
+    "Remap `hm` piecewise-linearly so that its current water level moves to `water_level`."
+    return water_level_remap(hm, find_water_level(hm, land_mass, exact), water_level)
+
+
+def water_level_remap(hm, new_water_level, water_level):
+    "Remap `hm` piecewise-linearly so that height `new_water_level` moves to `water_level`."
+    land_coef = (1.0 - water_level) / (1.0 - new_water_level)
+    water_coef = water_level / new_water_level
+    return np.where(hm > new_water_level,
+                    water_level + (hm - new_water_level) * land_coef,
+                    hm * water_coef).astype(np.float32)
+
+
+def stamp_hills(hm, xs, ys, radii, heights, tile_size=None):
+    """Add a batch of hills to `hm` in place, like repeated tcod.heightmap_add_hill calls.
+
+    With `tile_size`, the map is split into tiles that are stamped in parallel,
+    each tile only seeing the hills that overlap it.
+    """
+    xs, ys, radii, heights = (np.asarray(a, np.float64) for a in (xs, ys, radii, heights))
+    height, width = hm.shape
+    if tile_size is None:
+        kernels.add_hills(hm, xs, ys, radii, heights, 0, 0, width, height)
+    else:
+        kernels.add_hills_tiled(hm, xs, ys, radii, heights, tile_size)
+
+
+def block_reduce(arr, factor, func=np.sum):
+    """Reduce `arr` over blocks of `factor` x `factor` cells with `func`.
+
+    Blocks on the right and bottom edges that stick out of the map are padded
+    with zeros.
+    """
+    h, w = arr.shape
+    bh, bw = -(-h // factor), -(-w // factor)
+    padded = np.zeros((bh * factor, bw * factor), arr.dtype)
+    padded[:h, :w] = arr
+    return func(padded.reshape(bh, factor, bw, factor), axis=(1, 3))
+
+
+def interpolate_bilinear(arr, x, y):
+    """Bilinearly interpolate `arr` at the broadcast coordinate arrays `x`, `y`.
+
+    Coordinates are in cells of `arr` and are clamped to the map. Open grids
+    such as (xs[None, :], ys[:, None]) sample a whole (height, width) field.
+    """
+    h, w = arr.shape
+    x = np.clip(np.asarray(x, np.float64), 0, w - 1)
+    y = np.clip(np.asarray(y, np.float64), 0, h - 1)
+    ix, iy = x.astype(np.intp), y.astype(np.intp)
+    dx, dy = x - ix, y - iy
+    ix1, iy1 = np.minimum(ix + 1, w - 1), np.minimum(iy + 1, h - 1)
+    north = (1.0 - dx) * arr[iy, ix] + dx * arr[iy, ix1]
+    south = (1.0 - dx) * arr[iy1, ix] + dx * arr[iy1, ix1]
+    return ((1.0 - dy) * north + dy * south).astype(np.float32)
+
+
+def _slicer(axis):
+    "Return a function turning a slice into an index of a 2d array along `axis`."
+    if axis == 1:
+        return lambda sl: (slice(None), sl)
+    return lambda sl: (sl,)
+
+
+def box_blur(arr, radius=2, passes=4):
+    """Blur `arr` with a (2 * radius + 1)-wide box kernel, `passes` times in each direction.
+
+    Each pass runs a sum along the rows, then along the columns (see
+    kernels.box_blur_rows), so its cost does not depend on the radius. The
+    passes go back and forth between two preallocated float32 buffers. Near
+    the edges the box only averages the cells that are on the map.
+    """
+    out = np.array(arr, np.float32)
+    tmp = np.empty_like(out)
+    for _ in range(passes):
+        kernels.box_blur_rows(out, tmp, radius)
+        kernels.box_blur_columns(tmp, out, radius)
+    return out
+
+
+def latitude_precipitation(noise, ys, xs, width, height, spread):
+    """Extra precipitation of the cells at rows `ys` and columns `xs` of the map.
+
+    It follows the latitude with some `noise`, scaled by the `spread` of the
+    wind-borne precipitations. Only the middle half of the rows get any.
+    """
+    lat = (ys - height / 4) * 2 / height
+    coef = np.sin(2 * math.pi * lat)
+    #     // latitude (0 : equator, -1/1 : pole)
+    xs = xs / width
+    xcoef = coef[:, None] + 0.5 * sample_noise(noise, (xs[None, :], ys[:, None] / height), 3.0)
+    return spread * xcoef * 0.1
+
+
+def altitude_to_m(hm):
+    "Convert normalized altitudes to meters."
+    return np.interp(np.clip(256 * np.asarray(hm), 0, 255), altIndexes, altitudes)
+
+
+def precipitation_to_cm(prec):
+    "Convert normalized precipitation values to cm / m2 / year."
+    return np.interp(np.clip(256 * np.asarray(prec), 0, 255), precIndexes,
+                     precipitations)
+
+class MapDataGrid(object):
+    """Per-cell erosion and river data, stored as one typed array per field.
+
+    Indexing with [y, x] returns a MapData view of a single cell whose fields
+    read from and write to the underlying arrays.
+    """
+    fields = [
+        ('slope', np.float32),
+        ('area', np.float32),
+        ('flow_dir', np.int8),
+        ('up_dir', np.int8),
+        ('in_flags', np.uint8),
+        ('river_id', np.int32),
+        ('river_length', np.float32),
+    ]
+
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        for name, dtype in self.fields:
+            setattr(self, name, np.zeros((height, width), dtype))
+
+    @property
+    def shape(self):
+        return self.height, self.width
+
+    @property
+    def nbytes(self):
+        return sum(getattr(self, name).nbytes for name, _ in self.fields)
+
+    def __getitem__(self, index):
+        y, x = index
+        return MapData(self, y, x)
+
 
-@attr.s
 class MapData(object):
-    slope: float = attr.ib(default=0.0)
-    area: float = attr.ib(default=0.0)
-    flow_dir: float = attr.ib(default=0.0)
-    up_dir: int = attr.ib(default=0)
-    in_flags: int = attr.ib(default=0)
-    river_id: int = attr.ib(default=0)
-    river_length: float = attr.ib(default=0.0)
+    "A read/write view of one cell of a MapDataGrid."
+    __slots__ = ('_grid', '_index')
+
+    def __init__(self, grid, y, x):
+        self._grid = grid
+        self._index = (y, x)
+
+    def __repr__(self):
+        return 'MapData({})'.format(', '.join(
+            '{}={}'.format(name, getattr(self, name)) for name, _ in MapDataGrid.fields))
+
+
+def _map_data_field(name):
+    def fget(self):
+        return getattr(self._grid, name)[self._index]
+
+    def fset(self, value):
+        getattr(self._grid, name)[self._index] = value
+
+    return property(fget, fset)
+
+
+for _name, _ in MapDataGrid.fields:
+    setattr(MapData, _name, _map_data_field(_name))
 
 
 @attr.s
@@ -308,20 +948,107 @@ class River(object):
     strength: float = attr.ib(default=0.0)
 
 
-spec = [('width', int32),
-        ('height', int32),
-        ('_hm', float32[::1]),
-        ('_hm2', float32[::1]),
-        ('_precipitation', float32[::1]),
-        ('_hm_temperature', float32[::1]),
-        ('clouds_dx', float32),
-        ('clouds_dy', float32),
-        ('_clouds', float32[:]),
-        ('erosion_factor', float32),
-        ('max_erosion_alt', float32),
-        ('sedimentation_factor', float32),
-        ('mudslide_coef', float32),
-]
+class CloudLayer(object):
+    """Scrolling cloud thickness map, kept as a ring buffer of columns.
+
+    Screen column x shows world column x + offset, which is stored in buffer
+    column (x + offset) % width. Scrolling only advances the offset and fills
+    the newly exposed columns from `noise`.
+    """
+
+    def __init__(self, noise, width, height, columns=None):
+        self.noise = noise
+        self.width = width
+        self.height = height
+        if columns is None:
+            columns = np.zeros((height, width), np.float32)
+        self.columns = columns
+        self.offset = 0
+        self.dx = 0.0  # Fraction of a column scrolled past offset
+
+    def reset(self, columns):
+        "Replace the clouds with `columns`, in place, and scroll back to the start."
+        self.columns[:] = columns
+        self.offset = 0
+        self.dx = 0.0
+
+    def scroll(self, dx):
+        "Move the clouds `dx` columns to the left, generating the columns that appear."
+        self.dx += dx
+        cols = int(self.dx)
+        if cols <= 0:
+            return
+        self.dx -= cols
+        first = self.offset + self.width
+        xs = np.arange(max(first, first + cols - self.width), first + cols)
+        self.columns[:, xs % self.width] = cloud_layer(self.noise, xs, np.arange(self.height),
+                                                      self.width, self.height)
+        self.offset += cols
+
+    def to_array(self):
+        "The clouds in screen order, as a (height, width) array."
+        return np.roll(self.columns, -(self.offset % self.width), axis=1)
+
+    def thickness(self, x, y):
+        """Bilinearly interpolated thickness at screen coordinates (x, y).
+
+        x and y may be scalars or broadcastable arrays; they are clamped to the map.
+        """
+        x = np.clip(np.asarray(x, np.float64) + self.dx, 0, self.width - 1)
+        y = np.clip(np.asarray(y, np.float64), 0, self.height - 1)
+        ix, iy = x.astype(np.intp), y.astype(np.intp)
+        dx, dy = x - ix, y - iy
+        ix1, iy1 = np.minimum(ix + 1, self.width - 1), np.minimum(iy + 1, self.height - 1)
+        cx, cx1 = (ix + self.offset) % self.width, (ix1 + self.offset) % self.width
+        north = (1.0 - dx) * self.columns[iy, cx] + dx * self.columns[iy, cx1]
+        south = (1.0 - dx) * self.columns[iy1, cx] + dx * self.columns[iy1, cx1]
+        return (1.0 - dy) * north + dy * south
+
+
+@attr.s
+class Stage(object):
+    """A step of WorldGenerator.generate.
+
+    `run(wg)` reads the `inputs` attributes of the generator and writes its
+    `outputs`; `params` names the generator settings the outputs depend on.
+    Names may be dotted, as in 'map_data.flow_dir' or '_colors.land'.
+    """
+    name: str = attr.ib()
+    run = attr.ib()
+    inputs: tuple = attr.ib(default=())
+    outputs: tuple = attr.ib(default=())
+    params: tuple = attr.ib(default=())
+
+
+@attr.s
+class StageProgress(object):
+    """Passed to progress callbacks when a stage starts, progresses, is done, or is loaded.
+
+    `fraction` is set for the 'progress' events that some stages send while
+    they run, such as erosion after each iteration.
+    """
+    stage: str = attr.ib()
+    index: int = attr.ib()
+    count: int = attr.ib()
+    status: str = attr.ib()  # 'start', 'progress', 'done' or 'loaded'
+    fraction: float = attr.ib(default=None)
+
+
+def run_stage(wg, stages, index, progress=None):
+    "Run stage `index` of `stages` on `wg`, sending its events to `progress` if given."
+    stage, count = stages[index], len(stages)
+    if progress is None:
+        stage.run(wg)
+        return
+    progress(StageProgress(stage.name, index, count, 'start'))
+    wg._report = lambda fraction: progress(
+        StageProgress(stage.name, index, count, 'progress', fraction))
+    try:
+        stage.run(wg)
+    finally:
+        wg._report = None
+    progress(StageProgress(stage.name, index, count, 'done'))
+
 
 class WorldGenerator(object):
     def __init__(self,
@@ -331,73 +1058,94 @@ class WorldGenerator(object):
                  max_erosion_alt=0.9,
                  sedimentation_factor=0.01,
                  mudslide_coef=0.4,
-                 seed=None):
+                 seed=None,
+                 river_min_area=20.0,
+                 hill_cnt=600,
+                 land_mass=0.6):
         self.width = width
         self.height = height
         self._hm = new_heightmap(width, height)  # World Heightmap
         self._hm2 = new_heightmap(width, height)  # World map without erosion
         self._precipitation = new_heightmap(width, height)
         self._hm_temperature = new_heightmap(width, height)
-        self._biome_map = np.zeros((width, height))
-        self.cloud_dx, self.cloud_tot_dx = 0.0, 0.0
-        self._clouds = np.zeros((height, width))
-        self.random = random.Random(seed)  # Random number generator
+        self._biome_map = np.zeros((height, width), np.uint8)
+        self._colors = {}
+        self.seed = seed
+        # Root of the per-stage random streams; see seed_stream
+        self.seed_seq = np.random.SeedSequence(seed_entropy(seed))
+        # Python random generator for callers outside the stages, from its own stream
+        self.random = random.Random(noise_seed(self.seed_stream('random')))
         self.erosion_factor = erosion_factor
         self.max_erosion_alt = max_erosion_alt
         self.sedimentation_factor = sedimentation_factor
         self.mudslide_coef = mudslide_coef
-        self.noise = tcod.noise_new(2)  # noise.NoiseGenerator(2)
+        self.river_min_area = river_min_area
+        self.hill_cnt = hill_cnt
+        self.land_mass = land_mass
+        self.rivers = []
+        self._report = None  # Progress callback of the running stage; see report
+        self.noise1d = make_noise(1, self.seed_stream('noise1d'))
+        self.noise2d = make_noise(2, self.seed_stream('noise2d'))
+        self.clouds = CloudLayer(self.noise2d, width, height)
         #
-        map_data = [MapData() for _ in range(height * width)
-                    ]  #np.full((width, height),dtype=MapData)
-        self.map_data = np.array(map_data)
-        self.map_data.shape = (height, width)
-
-    def generate(self, hill_cnt=600):
-        # TODO: Add progress indication/messages.
-        print("Building heightmap...")
-        self.build_base_map(hill_cnt)
-
-        print("Calculating precipitation...")
-        self.compute_precipitation()
-
-        print("Eroding...")
-        self.erode_map()
-
-        print("Smoothing...")
-        self.smooth_map()
-        self.set_land_mass(0.6, SAND_HEIGHT)
-
-        print("Generating rivers...")
-        for i in range(self.width * self.height // 3000):
-            self.generate_rivers()
-        print("Smoothing precipitations...")
-        self.smooth_precipitations()
-        print("Determining temperature and biomes...")
-        self.compute_temperatures_and_biomes()
-        print("Setting colors...")
-        self.compute_colors()
+        self.map_data = MapDataGrid(width, height)
+
+    def seed_stream(self, name):
+        """The SeedSequence of the random stream `name`, spawned from the world seed.
+
+        Each stage and noise generator draws from its own stream, so a stage
+        produces the same result whatever ran before it.
+        """
+        return np.random.SeedSequence(
+            self.seed_seq.entropy,
+            spawn_key=self.seed_seq.spawn_key + (zlib.crc32(name.encode()),))
+
+    def rng(self, name):
+        "A numpy Generator drawing from the random stream `name`."
+        return np.random.default_rng(self.seed_stream(name))
+
+    def generate(self, hill_cnt=None, progress=None):
+        """Run every stage of STAGES in order.
+
+        `progress`, if given, is called with a StageProgress as each stage starts
+        and finishes, and as it progresses (see report). See worldgen_pipeline
+        for checkpointed, resumable runs and worldgen_instrument for observers
+        timing the stages.
+        """
+        if hill_cnt is not None:
+            self.hill_cnt = hill_cnt
+        for i in range(len(STAGES)):
+            run_stage(self, STAGES, i, progress)
+
+    def report(self, fraction):
+        "Tell the progress callback of the running stage that it is `fraction` done."
+        if self._report is not None:
+            self._report(fraction)
 
     def altitude(self, x, y):
         return self._hm[y, x]
 
     def interpolated_altitude(self, x, y):
-        return tcod.interpolated_value(self._hm, x, y)
+        "Bilinearly interpolated altitude at (x, y), which may be arrays."
+        return interpolate_bilinear(self._hm, x, y)
 
-    def real_altitude(self, x, y):
-        ih = clamp(0, 255, 256 * (self.interpolated_altitude(x, y)))
-        (i0, i1) = find_index(altIndexes, ih)
+    def real_altitude(self, x=None, y=None):
+        """Altitude in meters at (x, y), or over the whole map if no point is given.
 
-        return altitudes[i0] + (altitudes[i1] - altitudes[i0]) * (
-            ih - altIndexes[i0]) / (altIndexes[i1] - altIndexes[i0])
+        x and y may be scalars or broadcastable arrays of (fractional) coordinates.
+        """
+        if x is None and y is None:
+            return altitude_to_m(self._hm)
+        return altitude_to_m(self.interpolated_altitude(x, y))
 
-    def precipitation(self, x, y):
-        iprec = clamp(0, 255, 256 * (self._precipitation[y, x])
-                      )  # tcod.heightmap_get_value(self._precipitation, x,y)))
-        (i0, i1) = find_index(precIndexes, iprec)
+    def precipitation(self, x=None, y=None):
+        """Precipitation in cm / m2 / year at cell (x, y), or over the whole map.
 
-        return precipitations[i0] + (precipitations[i1] - precipitations[i0]) * (iprec - precIndexes[i0]) / \
-            (precIndexes[i1] - precIndexes[i0])
+        x and y may be scalars or broadcastable integer arrays.
+        """
+        if x is None and y is None:
+            return precipitation_to_cm(self._precipitation)
+        return precipitation_to_cm(self._precipitation[y, x])
 
     def temperature(self, x, y):
         return self._hm_temperature[y, x]
@@ -411,407 +1159,268 @@ class WorldGenerator(object):
     def on_sea_p(self, x, y):
         return self.interpolated_altitude(x, y) <= SAND_HEIGHT
 
-    @jit
-    def add_land(self, cnt, base_radius, radius_var, height):
-        for i in range(cnt):
-            min_radius = base_radius * (1.0 - radius_var)
-            max_radius = base_radius * (1.0 + radius_var)
-            radius = self.random.randrange(round(min_radius),
-                                           round(max_radius))
-            xh = self.random.randrange(0, self.width)
-            yh = self.random.randrange(0, self.height)
-            tcod.heightmap_add_hill(self._hm, xh, yh, radius, height)
-
-    @jit
-    def set_land_mass(self, land_mass, water_level):
-        "Ensure that a proportion <land_mass | [0,1]> of the map is above sea level."
-        heightcount = np.zeros(256)
-        for x in range(self.width):
-            for y in range(self.height):
-                h = self._hm[y, x]
-                if (h < 0):
-                    h = 0
-                ih = int(h * 255)
-                ih = clamp(0, 255, ih)
-                heightcount[ih] += 1
-        tcnt = 0
-        i = 0
-        while tcnt < (self.width * self.height * (1.0 - land_mass)):
-            tcnt += heightcount[i]
-            i += 1
-
-        new_water_level = i / 255.0
-        land_coef = (1.0 - water_level) / (1.0 - new_water_level)
-        water_coef = water_level / new_water_level
-        for x in range(self.width):
-            for y in range(self.height):
-                h = self._hm[y, x]
-                if h > new_water_level:
-                    h = water_level + (h - new_water_level) * land_coef
-                else:
-                    h = h * water_coef
-                self._hm[y, x] = h
-
-    @jit
+    def draw_hills(self, cnt, base_radius, radius_var, rng):
+        "Draw the centre columns, rows and radii of `cnt` hills from `rng`."
+        min_radius = base_radius * (1.0 - radius_var)
+        max_radius = base_radius * (1.0 + radius_var)
+        radii = rng.integers(round(min_radius), round(max_radius), cnt)
+        xs = rng.integers(0, self.width, cnt)
+        ys = rng.integers(0, self.height, cnt)
+        return xs, ys, radii
+
+    def add_land(self, cnt, base_radius, radius_var, height, rng):
+        xs, ys, radii = self.draw_hills(cnt, base_radius, radius_var, rng)
+        stamp_hills(self._hm, xs, ys, radii, np.full(cnt, height), tile_size=128)
+
+    def set_land_mass(self, land_mass, water_level, exact=False):
+        """Ensure that a proportion <land_mass | [0,1]> of the map is above sea level.
+
+        The current water level is read from a 256-bin height histogram unless
+        `exact` is set, in which case it is the exact quantile of the heights.
+        """
+        self._hm[:] = land_mass_remap(self._hm, land_mass, water_level, exact)
+
     def build_base_map(self, hill_cnt=60):
-        self.add_land(hill_cnt, 16 * self.width / 200, 0.7, 0.6)
+        self.add_land(hill_cnt, HILL_RADIUS * self.width, HILL_RADIUS_VAR, HILL_HEIGHT,
+                      self.rng('base_map'))
         tcod.heightmap_normalize(self._hm)
-        tcod.heightmap_add_fbm(self._hm, noise2d, 2.20 * self.width / 400,
-                               2.2 * self.width / 400, 0, 0, 10, 1.0, 2.05)
+        self.report(0.25)
+        self._hm += fbm_layer(self.noise2d, np.arange(self.width), np.arange(self.height),
+                              self.width, self.height, FBM_FREQUENCY * self.width,
+                              FBM_OCTAVES, FBM_DELTA, FBM_SCALE)
         tcod.heightmap_normalize(self._hm)
-        self._hm2 = self._hm.copy()
-        self.set_land_mass(0.6, SAND_HEIGHT)
+        self._hm2[:] = self._hm
+        self.report(0.5)
+        self.set_land_mass(self.land_mass, SAND_HEIGHT)
         # Fix land/mountain ratio using x^3 curve above sea level
-        for x in range(self.width):
-            for y in range(self.height):
-                h = self._hm[y, x]
-                if h >= SAND_HEIGHT:
-                    coef = (h - SAND_HEIGHT) / (1.0 - SAND_HEIGHT)
-                    h = SAND_HEIGHT + coef * coef * coef * (1.0 - SAND_HEIGHT)
-                    self._hm[y, x] = h
-
-        f = [0, 0]
-        for x in range(self.width):
-            f[0] = 6.0 * x / self.width
-            for y in range(self.height):
-                f[1] = 6.0 * y / self.height
-                self._clouds[y, x] = 0.5 * (1.0 + 0.8 * tcod.noise_get_fbm(
-                    noise2d, f, 4.0, tcod.NOISE_SIMPLEX))
+        kernels.land_curve(self._hm, SAND_HEIGHT)
+        self.report(0.6)
+
+        self.clouds.reset(cloud_layer(self.noise2d, np.arange(self.width), np.arange(self.height),
+                                      self.width, self.height))
 
     def smooth_map(self):
-        # 3x3 kernel for smoothing operations
-        smooth_ks = 9
-        smooth_dx = [-1, 0, 1, -1, 0, 1, -1, 0, 1]
-        smooth_dy = [-1, -1, -1, 0, 0, 0, 1, 1, 1]
-        smooth_weight = [2, 8, 2, 8, 20, 8, 2, 8, 2]
-
-        tcod.heightmap_kernel_transform(self._hm, smooth_ks, smooth_dx, smooth_dy,
-                                        smooth_weight, -1000, 1000)
-        tcod.heightmap_kernel_transform(self._hm2, smooth_ks, smooth_dx, smooth_dy,
-                                        smooth_weight, -1000, 1000)
+        smooth(self._hm)
+        smooth(self._hm2)
         tcod.heightmap_normalize(self._hm)
 
-    @jit
     def compute_precipitation(self):
         water_add, slope_coef, base_precip = 0.03, 2.0, 0.01
-        # // north/south winds
+        # north/south winds
         for dir_y in [-1, 1]:
-            for x in range(self.width - 1):
-                noisex = [x * 5 / self.width]
-                water_amount = 1.0 + tcod.noise_get_fbm(
-                    noise1d, noisex, 3.0, tcod.NOISE_SIMPLEX)
-                start_y = self.height - 1 if dir_y == -1 else 0
-                end_y = -1 if dir_y == -1 else self.height
-                for y in range(start_y, end_y, dir_y):
-                    h = self._hm[y, x]
-                    if x < SAND_HEIGHT:
-                        water_amount += water_add
-                    elif water_amount > 0.0:
-                        if (y + dir_y) < self.height:
-                            slope = self._hm[y + dir_y, x] - h
-                        else:
-                            slope = h - self._hm[y - dir_y, x]
-                        if slope >= 0:
-                            precip = water_amount * (base_precip +
-                                                     slope * slope_coef)
-                            self._precipitation[y, x] += precip
-                            water_amount -= precip
-                            water_amount = max(0.0, water_amount)
+            water = 1.0 + sample_noise(self.noise1d, [np.arange(self.width - 1) * 5 / self.width], 3.0)
+            kernels.precipitation_sweep(self._hm, self._precipitation, water, dir_y,
+                                        water_add, slope_coef, base_precip, SAND_HEIGHT)
 
         # east/west winds
         for dir_x in [-1, 1]:
-            for y in range(self.height - 1):
-                noisey = [y * 5 / self.height]
-                water_amount = 1.0 + tcod.noise_get_fbm(
-                    noise1d, noisey, 3.0, tcod.NOISE_SIMPLEX)
-                start_x = self.width - 1 if dir_x == -1 else 0
-                end_x = -1 if dir_x == -1 else self.width
-                for x in range(start_x, end_x, dir_x):
-                    h = self._hm[y, x]
-                    if x < SAND_HEIGHT:
-                        water_amount += water_add
-                    elif water_amount > 0.0:
-                        if (x + dir_x) < self.width:
-                            slope = self._hm[y, x + dir_x] - h
-                        else:
-                            slope = h - self._hm[y, x - dir_x]
-                        if slope >= 0:
-                            precip = water_amount * (base_precip +
-                                                     slope * slope_coef)
-                            self._precipitation[y, x] += precip
-                            water_amount -= precip
-                            water_amount = max(0.0, water_amount)
+            water = 1.0 + sample_noise(self.noise1d, [np.arange(self.height - 1) * 5 / self.height], 3.0)
+            kernels.precipitation_sweep(self._hm.T, self._precipitation.T, water, dir_x,
+                                        water_add, slope_coef, base_precip, SAND_HEIGHT)
 
         fmin, fmax = self._precipitation.min(), self._precipitation.max()
-        # latitude impact
-        for y in range(self.height // 4, 3 * self.height // 4):
-            lat = y - (self.height / 4) * (2 / self.height)
-            coef = math.sin(2 * math.pi * lat)
-            #     // latitude (0 : equator, -1/1 : pole)
-            for x in range(self.width):
-                f = [x / self.width, y / self.height]
-                xcoef = coef + 0.5 * tcod.noise_get_fbm(
-                    noise2d, f, 3.0, tcod.NOISE_SIMPLEX)
-                self._precipitation[y, x] += (fmax - fmin) * xcoef * 0.1
+        ys = np.arange(self.height // 4, 3 * self.height // 4)
+        self._precipitation[ys[0]:ys[-1] + 1] += latitude_precipitation(
+            self.noise2d, ys, np.arange(self.width), self.width, self.height, fmax - fmin)
         # very fast blur by scaling down and up
         factor = 8
-        small_width = int((self.width + factor) / factor)
-        small_height = int((self.height + factor) / factor)
-        low_res_map = np.zeros((small_width, small_height))
-        for x in range(self.width):
-            for y in range(self.height):
-                v = self._precipitation[y, x]
-                ix = int(x / factor)
-                iy = int(y / factor)
-                low_res_map[ix, iy] += v
-        coef = 1.0 / factor
-        for x in range(self.width):
-            for y in range(self.height):
-                v = get_interpolated_float(low_res_map, x * coef, y * coef,
-                                           small_width, small_height)
-                self._precipitation[y, x] = v
-
-    @jit
-    def erode_map(self):
-        new_map = new_heightmap(self.width, self.height)
-        # Compute flow and slope maps
-        for i in range(5, 1, -1):
-            for y in range(self.height):
-                for x in range(self.width):
-                    h = self._hm[y, x]
-                    md = self.map_data[y, x]
-                    hmin, hmax = h, h
-                    min_dir, max_dir = 0, 0
-                    for i in range(0, 8):
-                        ix = x + dirx[i]
-                        iy = y + diry[i]
-                        if in_rectangle(ix, iy, self.width, self.height):
-                            h2 = self._hm[iy, ix]
-                            if h2 < hmin:
-                                hmin = h2
-                                min_dir = i
-                            elif h2 > hmax:
-                                hmax = h2
-                                max_dir = i
-                    md.flow_dir = min_dir
-                    md.up_dir = max_dir
-                    md.slope = (hmin - h) * dircoef[min_dir]  # Is (hmin-h) only once?
-
-            for y in range(self.height):
-                for x in range(self.width):
-                    md = self.map_data[y, x]
-                    md2 = self.map_data[y, x]
-                    sediment, end, ix, iy, old_flow = 0, False, x, y, md.flow_dir
-                    while not end:
-                        h = self._hm[iy, ix]
-                        if h < (SAND_HEIGHT - 0.01):
-                            break
-                        if md2.flow_dir == oppdir[old_flow]:
-                            h += self.sedimentation_factor * sediment
-                            self._hm[iy, ix] = h
-                            end = True
-                        else:
-                            h += self.precipitation(
-                                ix, iy) * self.erosion_factor * md2.slope
-                            h = max(h, SAND_HEIGHT)
-                            sediment -= md2.slope
-                            self._hm[iy, ix] = h
-                            old_flow = md2.flow_dir
-                            ix += dirx[old_flow]
-                            iy += diry[old_flow]
-                            md2 = self.map_data[iy, ix]
-
+        low_res_map = block_reduce(self._precipitation, factor)
+        xs = np.arange(self.width) / factor
+        ys = np.arange(self.height) / factor
+        self._precipitation[:] = interpolate_bilinear(low_res_map, xs[None, :], ys[:, None])
+
+    def erode_map(self, iterations=4):
+        """Erode the heightmap, then run the mudslide smoothing pass.
+
+        Each of the `iterations` passes recomputes the flow and slope maps and
+        erodes along every flow path at once (see erosion_pass). The result
+        matches the old per-cell loop to within 1e-5 once that loop is made to
+        visit all eight neighbours without wrapping around the map edges; the
+        remaining difference comes from float32 summation order.
+        """
+        hm, flow_dir, up_dir, slope = erode(
+            self._hm, precipitation_to_cm(self._precipitation), iterations,
+            self.erosion_factor, self.sedimentation_factor, self.report)
+        self.map_data.flow_dir[:] = flow_dir
+        self.map_data.up_dir[:] = up_dir
+        self.map_data.slope[:] = slope
+        self.map_data.in_flags[:] = inflow_flags(flow_dir)
         # Mudslides and smoothing
-        sand_coef = 1 / (1 - SAND_HEIGHT)
-        for x in range(self.width):
-            for y in range(self.height):
-                h = self._hm[y, x]
-                if (h < SAND_HEIGHT - 0.01) or (h >= self.max_erosion_alt):
-                    new_map[y, x] = h
-                    continue
-                sum_delta1, sum_delta2 = 0.0, 0.0
-                nb1, nb2 = 1, 1
-                for i in range(1, 8):
-                    ix = x + dirx[i]
-                    iy = y + diry[i]
-                    if (in_rectangle(ix, iy, self.width, self.height)):
-                        ih = self._hm[iy, ix]
-                        if ih < h:
-                            # Diagonal neighbors
-                            if (i == 1) or (i == 3) or (i == 6) or (i == 8):
-                                sum_delta1 += (ih - h) * 0.4
-                                nb1 += 1
-                            else:  # Adjacent neighbor
-                                sum_delta2 += (ih - h) * 1.6
-                                nb2 += 1
-                dh = sum_delta1 / nb1 + sum_delta2 / nb2
-                dh *= self.mudslide_coef
-                hcoef = (h - SAND_HEIGHT) * sand_coef
-                dh *= (1.0 - hcoef * hcoef * hcoef
-                       )  # Smoothing decrease as altitude increases
-                new_map[y, x] = h + dh
-        self._hm = new_map.copy()
+        self._hm[:] = mudslide(hm, self.max_erosion_alt, self.mudslide_coef)
+
+    @property
+    def _clouds(self):
+        """A read-only snapshot of the clouds in screen order.
+
+        Writing to it raises; assign a whole array, or modify self.clouds, instead.
+        """
+        clouds = self.clouds.to_array()
+        clouds.setflags(write=False)
+        return clouds
+
+    @_clouds.setter
+    def _clouds(self, columns):
+        self.clouds.reset(columns)
 
     def update_clouds(self, elapsed_time):
-        self.cloud_tot_dx += elapsed_time * 5
-        self.cloud_dx += elapsed_time * 5
-        if self.cloud_dx >= 1.0:
-            cols_to_translate = int(self.cloud_dx)
-            self.cloud_dx -= cols_to_translate
-            for x in range(cols_to_translate, self.width):
-                for y in range(0, self.height):
-                    self._clouds[x - cols_to_translate, y] = self._clouds[y, x]
-        f = [0, 0]
-        for x in range(self.width - cols_to_translate, self.width):
-            for y in range(0, self.height):
-                f[0] = 6.0 * (x + self.cloud_tot_dx) / self.width
-                f[1] = 6.0 * y / self.height
-                self._clouds[y, x] = 0.5 * (1.0 + 0.8 * tcod.noise_get_fbm(
-                    self.noise, f, 4.0, tcod.NOISE_SIMPLEX))
+        self.clouds.scroll(elapsed_time * 5)
 
-    @property
     def cloud_thickness(self, x, y):
-        x += self.cloud_dx
-        ix, iy = int(x), int(y)
-        ix1 = min([self.width - 1, ix + 1])
-        iy1 = min([self.height - 1, iy + 1])
-        fdx, fdy = x - ix, y - iy
-        v1 = self._clouds[ix, iy]
-        v2 = self._clouds[ix1, iy1]
-        v3 = self._clouds[ix, iy1]
-        v4 = self._clouds[ix1, iy1]
-        vx1 = (1.0 - fdx) * v1 + fdx * v2
-        vx2 = (1.0 - fdx) * v3 + fdx * v4
-        return (1.0 - fdy) * vx1 + fdy * vx2
-
-    def generate_rivers(self):
-        river_id = 0
-        # Source = sx, sy
-        # Destination = dx, dy
-
-        # Pick a random point near the coast
-        sx = random.randint(0, self.width)
-        sy = random.randint(self.height / 5, 4 * self.height / 5)
-        h = self._hm[sy, sx]
-        while (h < SAND_HEIGHT - 0.02) or (h >= SAND_HEIGHT):
-            sx += 1
-            if sx == self.width:
-                sx = 0
-                sy += 1
-                if sy == self.height:
-                    sy = 0
-            h = self._hm[sy, s]
-
-        tree, rand_pt = [], []
-        tree.insert(0, (sx, sy))
-        river_id += 1
-        dx, dy = sx, sy
-        for i in range(random.randint(50, 200)):
-            rx = random.randint(sx - 200, sx + 200)
-            ry = random.randint(sy - 200, sy + 200)
-            rand_pt.insert(0, (rx, ry))
-        for (rx, ry) in rand_pt:
-            min_dist = 1E10
-            best_x, best_y = -1, -1
-            for (tx, ty) in tree:
-                dist = (tx - rx) * (tx - rx) + (ty - ry) * (ty - ry)
-                if dist < min_dist:
-                    min_dist = dist
-                    best_x, best_y = tx, ty
-            tcod.line_init(best_x, best_y, rx, ry)
-            len, cx, cy = 3, best_x, best_y
-            md = self.map_data[cx, cy]
-            if md.river_id == river_id:
-                md.river_id = 0
-            while len > 0:
-                md = self.map_data[cy, cx]
-                if md.river_id > 0:
+        "Cloud thickness at (x, y), which may be arrays of fractional coordinates."
+        return self.clouds.thickness(x, y)
+
+    def generate_rivers(self, min_area=None):
+        """Build the river network from the flow directions of the current heightmap.
+
+        Every cell drains along its steepest descent, with depressions routed
+        out through their spill points (see drainage_directions), so all flow
+        reaches the sea or the map edge. The land cells whose
+        precipitation-weighted drainage area reaches `min_area` (by default
+        river_min_area) become rivers, filling self.rivers and the area, river_id
+        and river_length fields of map_data. River cells get full precipitation.
+
+        Each cell weighs its precipitation normalized to [0, 1] over the map, so
+        areas count cells of the map's heaviest rainfall and never decrease
+        downstream.
+        """
+        if min_area is None:
+            min_area = self.river_min_area
+        md = self.map_data
+        flow_dir = drainage_directions(self._hm, SAND_HEIGHT)
+        md.flow_dir[:] = flow_dir
+        md.up_dir[:] = flow_directions(self._hm)[1]
+        md.slope[:] = flow_slope(self._hm, flow_dir)
+        md.in_flags[:] = inflow_flags(flow_dir)
+        self.report(0.3)
+        weights = self._precipitation - self._precipitation.min()
+        spread = weights.max()
+        md.area[:] = flow_accumulation(flow_dir, weights / spread if spread > 0 else 1.0)
+        self.report(0.6)
+        self.rivers, md.river_id[:], md.river_length[:] = trace_rivers(
+            flow_dir, md.area, self._hm >= SAND_HEIGHT, min_area)
+        self.report(0.9)
+        self._precipitation[md.river_id > 0] = 1.0
+
+    def coastal_cells(self):
+        "(x, y) arrays of the shallow water cells in the middle 3/5 of the map's rows."
+        h = self._hm
+        coast = (h >= SAND_HEIGHT - 0.02) & (h < SAND_HEIGHT)
+        coast[:self.height // 5] = False
+        coast[4 * self.height // 5:] = False
+        ys, xs = np.nonzero(coast)
+        return xs, ys
+
+    def grow_river_tree(self, river_id, sx, sy, rng):
+        """Grow a river from (sx, sy) as a random tree towards 50 to 200 random points.
+
+        Each point extends the tree node closest to it by up to three cells of
+        the line joining them, marking land cells with `river_id` and full
+        precipitation. Points are drawn in one batch from the numpy generator `rng`.
+        """
+        md = self.map_data
+        tree = NodeGrid()
+        tree.add(sx, sy)
+        cnt = rng.integers(50, 201)
+        points = np.stack([rng.integers(sx - 200, sx + 201, cnt),
+                           rng.integers(sy - 200, sy + 201, cnt)], axis=-1)
+        for rx, ry in points.tolist():
+            best_x, best_y = tree.nearest(rx, ry)
+            if md.river_id[best_y, best_x] == river_id:
+                md.river_id[best_y, best_x] = 0
+            cx, cy = best_x, best_y
+            for cx, cy in tcod.los.bresenham((best_x, best_y), (rx, ry))[:3].tolist():
+                if md.river_id[cy, cx] > 0:
                     break
-                h = self._hm[cy, c]
-                if h >= SAND_HEIGHT:
-                    md.river_id = river_id
-                    self._precipitation[cx, cy] = 1.0
+                if self._hm[cy, cx] >= SAND_HEIGHT:
+                    md.river_id[cy, cx] = river_id
+                    self._precipitation[cy, cx] = 1.0
                 if cx == 0 or cx == self.width - 1 or cy == 0 or cy == self.height - 1:
-                    len = 0
-                else:
-                    cx, cy = tcod.line_step()
-                    if cx is None or cy is None:
-                        len = 0
-                len -= 1
-            if (cx + cy * self.width != best_x + best_y * self.width):
-                tree.insert(0, (cx, cy))
-
-    def smooth_precipitations(self):
-        temphm = self._precipitation.copy()
-        hm_data = self._precipitation
-        for i in range(4, 0, -1):
-            for x in range(self.width):
-                minx = max((0, x - 2))
-                maxx = min((self.width - 1, x + 2))
-                miny = 0
-                maxy = 2
-                psum = np.sum(hm_data[minx:maxx, miny:maxy])
-                pcount = (maxy - miny) * (maxx - minx)
-                temphm[x, 0] = psum / pcount
-                for y in range(1, self.height):
-                    if (y - 2) >= 0:
-                        psum -= np.sum(hm_data[minx:maxx, y - 2])
-                        pcount -= (maxx - minx)
-                    if (y + 2) < self.height:
-                        psum += np.sum(hm_data[minx:maxx, y + 2])
-                        pcount += (maxx - minx)
-                    temphm[y, x] = psum / pcount
-        self._precipitation = temphm.copy()
+                    break
+            if (cx, cy) != (best_x, best_y):
+                tree.add(cx, cy)
+
+    def generate_river_trees(self, count=None):
+        """Grow `count` random-tree rivers (by default one per 3000 cells) from the coast.
+
+        An alternative to the drainage rivers of generate_rivers; new river ids
+        follow the ones already in map_data.
+        """
+        if count is None:
+            count = self.width * self.height // 3000
+        xs, ys = self.coastal_cells()
+        if not xs.size:
+            return
+        rng = self.rng('river_trees')
+        first_id = int(self.map_data.river_id.max()) + 1
+        for river_id, i in enumerate(rng.integers(0, xs.size, count), first_id):
+            self.grow_river_tree(river_id, int(xs[i]), int(ys[i]), rng)
+            self.report((river_id - first_id + 1) / count)
+
+    def smooth_precipitations(self, radius=2, passes=4):
+        self._precipitation[:] = box_blur(self._precipitation, radius, passes)
         tcod.heightmap_normalize(self._precipitation)
 
     def compute_temperatures_and_biomes(self):
-        sand_coef = 1.0 / (1.0 - SAND_HEIGHT)
-        water_coef = 1.0 / SAND_HEIGHT
-        for y in range(self.height):
-            lat = (y - self.height / 2) * 2 / self.height
-            lat_temp = 0.5 * (1.0 + math.pow(math.sin(math.pi *
-                                                      (lat + 0.5)), 5))
-            lat_temp = math.sqrt(lat_temp) if lat_temp > 0.0 else lat_temp
-            lat_temp = -30 + lat_temp * 60
-            for x in range(self.width):
-                h0 = self._hm[y, x]
-                h = h0 - SAND_HEIGHT
-                h = (h * water_coef) if h < 0.0 else h * sand_coef
-                alt_shift = h * -35
-                temp = lat_temp + alt_shift
-                self._hm_temperature[y, x] = temp
-                humid = self._precipitation[y, x]
-                climate = get_climate_from_temp(temp)
-                i_humid = round(humid * 5)
-                i_humid = int( min(4, i_humid) )
-                self._biome_map[y, x] = biome_diagram[climate.value][i_humid].value
-
-    def biome_color(self, biome, x, y):
-        r = biome_colors[biome].r
-        g = biome_colors[biome].g
-        b = biome_colors[biome].b
-        count = 0
-        for i in range(4):
-            ix = x + random.randint(-10, 10)
-            iy = y + random.randint(-10, 10)
-            if in_rectangle(ix, iy, self.width, self.height):
-                c = biome_colors(self.biome_map[ix, iy])
-                r += c.r + random.randint(-10, 10)
-                g += c.g + random.randint(-10, 10)
-                b += c.b + random.randint(-10, 10)
-                count += 1
-        r /= count
-        g /= count
-        b /= count
-        r, g, b = clamp(0, 255, r), clamp(0, 255, g), clamp(0, 255, b)
-        return Color(r, g, b)
+        self._hm_temperature[:], self._biome_map[:] = temperatures_and_biomes(
+            self._hm, self._precipitation, np.arange(self.height), self.height)
+
+    def biome_color(self, x, y):
+        "The blended biome color of a cell, as computed by compute_colors."
+        return Color(*self._colors['biome'][int(y), int(x)])
 
     def compute_colors(self):
-        for y in range(self.height):
-            for x in range(self.width):
-                h = self.altitude(x, y)
-                temp = self.temperature(x, y)
-                biome = self.biome(x, y)
+        """Render the land, altitude, precipitation, temperature and biome views.
+
+        Each view is a (height, width, 3) uint8 image stored in self._colors,
+        overwriting the views already there in place.
+        """
+        self.set_colors(colorize(self._hm, self._precipitation, self._hm_temperature,
+                                 self._biome_map, self.rng('colors')))
+
+    def set_colors(self, colors):
+        "Store the views of `colors`, writing into the existing arrays of self._colors."
+        for view, image in colors.items():
+            if view in self._colors:
+                self._colors[view][:] = image
+            else:
+                self._colors[view] = image
+
+
+# Generation stages
+# -----------------
+
+_flow_fields = ('map_data.flow_dir', 'map_data.up_dir', 'map_data.slope', 'map_data.in_flags')
+_river_fields = ('map_data.area', 'map_data.river_id', 'map_data.river_length')
+color_views = ('land', 'altitude', 'precipitation', 'temperature', 'biome')
+
+
+def _smooth_land(wg):
+    wg.smooth_map()
+    wg.set_land_mass(wg.land_mass, SAND_HEIGHT)
+
+
+STAGES = [
+    Stage('base_map', lambda wg: wg.build_base_map(wg.hill_cnt),
+          outputs=('_hm', '_hm2', '_clouds'), params=('hill_cnt', 'land_mass')),
+    Stage('precipitation', WorldGenerator.compute_precipitation,
+          inputs=('_hm',), outputs=('_precipitation',)),
+    Stage('erosion', WorldGenerator.erode_map,
+          inputs=('_hm', '_precipitation'), outputs=('_hm',) + _flow_fields,
+          params=('erosion_factor', 'sedimentation_factor', 'max_erosion_alt', 'mudslide_coef')),
+    Stage('smoothing', _smooth_land,
+          inputs=('_hm', '_hm2'), outputs=('_hm', '_hm2'), params=('land_mass',)),
+    Stage('rivers', WorldGenerator.generate_rivers,
+          inputs=('_hm', '_precipitation'),
+          outputs=('_precipitation', 'rivers') + _flow_fields + _river_fields,
+          params=('river_min_area',)),
+    Stage('smooth_precipitations', WorldGenerator.smooth_precipitations,
+          inputs=('_precipitation',), outputs=('_precipitation',)),
+    Stage('temperatures_and_biomes', WorldGenerator.compute_temperatures_and_biomes,
+          inputs=('_hm', '_precipitation'), outputs=('_hm_temperature', '_biome_map')),
+    Stage('colors', WorldGenerator.compute_colors,
+          inputs=('_hm', '_precipitation', '_hm_temperature', '_biome_map'),
+          outputs=tuple('_colors.' + view for view in color_views)),
+]
 
 
 # Tests
@@ -0,0 +1,153 @@
+"""Benchmark of the world generation stages at growing map sizes.
+
+Times every stage of worldgen.STAGES on square maps of each of the given
+sizes, records the peak memory the stage allocates, and fits how the time of
+each stage scales with the number of cells: an exponent of 1 is linear, and
+stages above 1 + tolerance are flagged as superlinear. Run it as a script to
+print a table and optionally save the results as JSON for regression tracking:
+
+    python worldgen_bench.py --sizes 128 256 512 1024 2048 --output bench.json
+
+Timings are the best of `repeat` runs, taken without tracemalloc, which slows
+down Python code; peak memory comes from one more run with tracemalloc on.
+"""
+import argparse
+import json
+import platform
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+import worldgen
+from worldgen_cache import code_version
+
+SIZES = (128, 256, 512, 1024, 2048)
+
+
+def run_stages(size, seed=0, traced=False):
+    """Generate a `size` x `size` world; return {stage: seconds} or, if `traced`, {stage: peak bytes}.
+
+    The peak counts the memory allocated during the stage on top of what was
+    allocated when it started.
+    """
+    wg = worldgen.WorldGenerator(size, size, seed=seed)
+    results = {}
+    started = {}
+
+    def progress(event):
+        if event.status == 'start':
+            if traced:
+                tracemalloc.reset_peak()
+                started[event.stage] = tracemalloc.get_traced_memory()[0]
+            else:
+                started[event.stage] = time.perf_counter()
+        elif traced:
+            results[event.stage] = tracemalloc.get_traced_memory()[1] - started[event.stage]
+        else:
+            results[event.stage] = time.perf_counter() - started[event.stage]
+
+    if traced:
+        tracemalloc.start()
+        try:
+            wg.generate(progress=progress)
+        finally:
+            tracemalloc.stop()
+    else:
+        wg.generate(progress=progress)
+    return results
+
+
+def scaling_exponents(sizes, seconds):
+    """Least squares slope of log(time) against log(cells) for each stage.
+
+    `seconds` maps each stage to its times at `sizes`.
+    """
+    cells = np.log(np.asarray(sizes, np.float64) ** 2)
+    return {stage: float(np.polyfit(cells, np.log(np.maximum(times, 1e-9)), 1)[0])
+            for stage, times in seconds.items()}
+
+
+def benchmark(sizes=SIZES, repeat=3, seed=0, memory=True, tolerance=0.15, log=None):
+    """Benchmark the stages at every size of `sizes`; return the results as a JSON-able dict.
+
+    `log`, if given, is called with a line of text as each size completes.
+    """
+    run_stages(min(sizes), seed)  # Compile the kernels before timing them
+    stages = [stage.name for stage in worldgen.STAGES]
+    seconds = {stage: [] for stage in stages}
+    peaks = {stage: [] for stage in stages}
+    for size in sizes:
+        runs = [run_stages(size, seed) for _ in range(repeat)]
+        for stage in stages:
+            seconds[stage].append(min(run[stage] for run in runs))
+        if memory:
+            peak = run_stages(size, seed, traced=True)
+            for stage in stages:
+                peaks[stage].append(peak[stage])
+        if log is not None:
+            log('{}x{}: {:.3f}s'.format(size, size, sum(seconds[s][-1] for s in stages)))
+    exponents = scaling_exponents(sizes, seconds) if len(sizes) > 1 else {}
+    return {
+        'code_version': code_version(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'sizes': list(sizes),
+        'repeat': repeat,
+        'seed': seed,
+        'stages': {stage: {'seconds': seconds[stage],
+                           'peak_bytes': peaks[stage] if memory else None,
+                           'exponent': exponents.get(stage)}
+                   for stage in stages},
+        'tolerance': tolerance,
+        'superlinear': [stage for stage in stages
+                        if exponents.get(stage, 0.0) > 1.0 + tolerance],
+    }
+
+
+def format_table(results):
+    "The results of benchmark as a text table, one row per stage."
+    sizes = results['sizes']
+    lines = ['{:<24}'.format('stage') + ''.join('{:>10}'.format(s) for s in sizes)
+             + '{:>10}{:>12}'.format('exponent', 'peak MB')]
+    for stage, data in results['stages'].items():
+        exponent = data['exponent']
+        peak = data['peak_bytes'][-1] / 2 ** 20 if data['peak_bytes'] else float('nan')
+        flag = ' !' if stage in results['superlinear'] else ''
+        lines.append('{:<24}'.format(stage)
+                     + ''.join('{:>10.4f}'.format(t) for t in data['seconds'])
+                     + '{:>10}'.format('-' if exponent is None else '{:.2f}'.format(exponent))
+                     + '{:>12.1f}'.format(peak) + flag)
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=list(SIZES),
+                        help='map sizes to benchmark (default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs per size')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-memory', dest='memory', action='store_false',
+                        help='skip the tracemalloc run')
+    parser.add_argument('--tolerance', type=float, default=0.15,
+                        help='scaling exponent above 1 tolerated before flagging a stage')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    parser.add_argument('--strict', action='store_true',
+                        help='exit with status 1 if a stage scales superlinearly')
+    args = parser.parse_args(argv)
+    results = benchmark(args.sizes, args.repeat, args.seed, args.memory, args.tolerance,
+                        log=lambda line: print(line, file=sys.stderr))
+    print(format_table(results))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1)
+    if results['superlinear']:
+        print('Superlinear stages: ' + ', '.join(results['superlinear']))
+        if args.strict:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,113 @@
+"""On-disk cache of finished worlds, addressed by their generation settings.
+
+A world is fully determined by its constructor settings, its seed and the code
+generating it, so WorldCache stores each finished world under a hash of those.
+Every entry is a directory of .npy files, one per array written by
+worldgen.STAGES, that loads as copy-on-write memory maps. The least recently
+used entries are evicted once the cache exceeds its size cap.
+"""
+import hashlib
+import json
+import os
+import shutil
+import uuid
+
+import numpy as np
+
+import worldgen
+from worldgen_pipeline import code_version, get_value, set_value, encode, decode
+
+# Generator settings that, with the seed, determine the world
+settings = ('width', 'height', 'erosion_factor', 'max_erosion_alt', 'sedimentation_factor',
+            'mudslide_coef', 'river_min_area', 'hill_cnt', 'land_mass', 'seed')
+
+def world_key(wg):
+    "Cache key of the world `wg` generates, or None if it is unseeded."
+    if wg.seed is None:
+        return None
+    params = {name: getattr(wg, name) for name in settings}
+    blob = json.dumps([code_version(), params], sort_keys=True, default=repr)
+    return hashlib.sha256(blob.encode()).hexdigest()
+
+
+def world_fields(stages=None):
+    "Names of the generator attributes written by `stages`, in order."
+    fields = {}
+    for stage in worldgen.STAGES if stages is None else stages:
+        fields.update(dict.fromkeys(stage.outputs))
+    return list(fields)
+
+
+class WorldCache(object):
+    """Finished worlds in `directory`, using at most about `max_bytes` of disk."""
+
+    def __init__(self, directory, max_bytes=1 << 30):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def entry_path(self, key):
+        return os.path.join(self.directory, key)
+
+    def load(self, wg):
+        """Fill `wg` with its cached world. Return False if it is not cached."""
+        key = world_key(wg)
+        path = key and self.entry_path(key)
+        if path is None or not os.path.isdir(path):
+            return False
+        data = {name[:-4]: np.load(os.path.join(path, name), mmap_mode='c')
+                for name in os.listdir(path) if name.endswith('.npy')}
+        for name in world_fields():
+            set_value(wg, name, decode(name, data))
+        os.utime(path)  # Mark as recently used
+        return True
+
+    def store(self, wg):
+        "Save the finished world `wg`, then evict old entries over the size cap."
+        key = world_key(wg)
+        if key is None:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        arrays = {}
+        for name in world_fields():
+            arrays.update(encode(name, get_value(wg, name)))
+        tmp = os.path.join(self.directory, '.tmp-' + uuid.uuid4().hex)
+        os.makedirs(tmp)
+        for name, arr in arrays.items():
+            np.save(os.path.join(tmp, name + '.npy'), arr)
+        try:
+            os.replace(tmp, self.entry_path(key))
+        except OSError:  # Stored meanwhile by another process
+            shutil.rmtree(tmp, ignore_errors=True)
+        self.evict(keep=key)
+
+    def entries(self):
+        "(last use, size, path) of every entry, least recently used first."
+        if not os.path.isdir(self.directory):
+            return []
+        entries = []
+        for key in os.listdir(self.directory):
+            path = self.entry_path(key)
+            if key.startswith('.') or not os.path.isdir(path):
+                continue
+            size = sum(e.stat().st_size for e in os.scandir(path))
+            entries.append((os.stat(path).st_mtime, size, path))
+        return sorted(entries)
+
+    def evict(self, keep=None):
+        "Remove the least recently used entries until the cache fits in max_bytes."
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            if keep is not None and path == self.entry_path(keep):
+                continue
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+    def generate(self, wg, progress=None):
+        "Load the world of `wg` from the cache, or generate and store it."
+        if not self.load(wg):
+            wg.generate(progress=progress)
+            self.store(wg)
+        return wg
@@ -0,0 +1,200 @@
+"""Instrumentation of world generation stages.
+
+An Instrument is a progress callback for WorldGenerator.generate,
+Pipeline.run or generate_tiled. It measures the wall time, CPU time and change
+in the array memory of the generator for every stage, and passes a StageEvent
+to each of its observers as the stage starts, progresses and ends:
+
+    trace = ChromeTrace()
+    wg.generate(progress=Instrument(wg, LogObserver(), trace))
+    trace.save('worldgen.trace.json')
+
+Observers subclass Observer and override the methods for the events they want.
+LogObserver logs the events, Profiler profiles each stage with cProfile or
+pyinstrument, and ChromeTrace exports them as Chrome trace events, which
+chrome://tracing and Perfetto display as a timeline.
+"""
+import cProfile
+import io
+import json
+import logging
+import os
+import pstats
+import threading
+import time
+
+import attr
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def array_bytes(wg):
+    "Total size of the arrays held by the generator `wg`, its map data, clouds and colors."
+    objects = [vars(wg), vars(wg.map_data), vars(wg.clouds), wg._colors]
+    return sum(value.nbytes for obj in objects for value in obj.values()
+               if isinstance(value, np.ndarray))
+
+
+@attr.s
+class StageEvent(object):
+    """A measurement of a stage, passed to the observers of an Instrument.
+
+    `wall` and `cpu` are the seconds and `memory` the change in array bytes
+    since the stage started; they are 0 for 'start' events and for stages
+    loaded from a checkpoint. `fraction` is set for 'progress' events.
+    """
+    stage: str = attr.ib()
+    index: int = attr.ib()
+    count: int = attr.ib()
+    status: str = attr.ib()  # 'start', 'progress', 'done' or 'loaded'
+    wall: float = attr.ib(default=0.0)
+    cpu: float = attr.ib(default=0.0)
+    memory: int = attr.ib(default=0)
+    fraction: float = attr.ib(default=None)
+
+
+class Observer(object):
+    "Receives the StageEvents of an Instrument; every method does nothing by default."
+
+    def stage_start(self, event):
+        pass
+
+    def stage_progress(self, event):
+        pass
+
+    def stage_end(self, event):
+        "Called when a stage is done, or with status 'loaded' when it was loaded."
+        pass
+
+
+class Instrument(object):
+    """Progress callback measuring the stages run on `wg` for `observers`."""
+
+    def __init__(self, wg, *observers):
+        self.wg = wg
+        self.observers = list(observers)
+        self._start = None
+
+    def measure(self, progress):
+        if progress.status == 'start':
+            self._start = (time.perf_counter(), time.process_time(), array_bytes(self.wg))
+            return StageEvent(progress.stage, progress.index, progress.count, 'start')
+        if progress.status == 'loaded':
+            return StageEvent(progress.stage, progress.index, progress.count, 'loaded')
+        wall, cpu, memory = self._start
+        return StageEvent(progress.stage, progress.index, progress.count, progress.status,
+                          time.perf_counter() - wall, time.process_time() - cpu,
+                          array_bytes(self.wg) - memory, progress.fraction)
+
+    def __call__(self, progress):
+        event = self.measure(progress)
+        method = {'start': 'stage_start', 'progress': 'stage_progress'}.get(
+            event.status, 'stage_end')
+        for observer in self.observers:
+            getattr(observer, method)(event)
+
+
+class LogObserver(Observer):
+    """Log every event to `log` (by default this module's logger) at `level`."""
+
+    def __init__(self, log=None, level=logging.INFO):
+        self.log = logger if log is None else log
+        self.level = level
+
+    def stage_start(self, event):
+        self.log.log(self.level, '[%d/%d] %s started', event.index + 1, event.count, event.stage)
+
+    def stage_progress(self, event):
+        self.log.log(self.level, '[%d/%d] %s %.0f%% (%.3fs)', event.index + 1, event.count,
+                     event.stage, 100 * event.fraction, event.wall)
+
+    def stage_end(self, event):
+        if event.status == 'loaded':
+            self.log.log(self.level, '[%d/%d] %s loaded', event.index + 1, event.count,
+                         event.stage)
+            return
+        self.log.log(self.level, '[%d/%d] %s done in %.3fs (cpu %.3fs, arrays %+.1f MB)',
+                     event.index + 1, event.count, event.stage, event.wall, event.cpu,
+                     event.memory / 2 ** 20)
+
+
+class Profiler(Observer):
+    """Profile each stage with cProfile or, if `backend` is 'pyinstrument', pyinstrument.
+
+    The profile of a stage is kept in self.profiles under its name: a
+    cProfile.Profile or a pyinstrument Profiler. report formats it as text.
+    """
+
+    def __init__(self, backend='cprofile'):
+        if backend not in ('cprofile', 'pyinstrument'):
+            raise ValueError('Unknown profiler {!r}'.format(backend))
+        self.backend = backend
+        self.profiles = {}
+        self._profile = None
+
+    def stage_start(self, event):
+        if self.backend == 'pyinstrument':
+            from pyinstrument import Profiler as PyinstrumentProfiler
+            self._profile = PyinstrumentProfiler()
+            self._profile.start()
+        else:
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+
+    def stage_end(self, event):
+        if self._profile is None:
+            return
+        if self.backend == 'pyinstrument':
+            self._profile.stop()
+        else:
+            self._profile.disable()
+        self.profiles[event.stage], self._profile = self._profile, None
+
+    def report(self, stage, limit=20, sort='cumulative'):
+        "The profile of `stage` as text, showing the top `limit` functions for cProfile."
+        profile = self.profiles[stage]
+        if self.backend == 'pyinstrument':
+            return profile.output_text()
+        out = io.StringIO()
+        pstats.Stats(profile, stream=out).sort_stats(sort).print_stats(limit)
+        return out.getvalue()
+
+
+class ChromeTrace(Observer):
+    """Collect the stages as Chrome trace events; save writes them as JSON.
+
+    Each stage is a complete ('X') event lasting its wall time, with its CPU
+    time and memory change as arguments, and progress events add to a
+    'progress' counter track.
+    """
+
+    def __init__(self):
+        self.events = []
+        self._origin = time.perf_counter()
+        self._pid = os.getpid()
+
+    def _timestamp(self, seconds_ago=0.0):
+        "Microseconds since the trace started, `seconds_ago` before now."
+        return (time.perf_counter() - seconds_ago - self._origin) * 1e6
+
+    def _event(self, **fields):
+        fields.update(pid=self._pid, tid=threading.get_ident())
+        self.events.append(fields)
+
+    def stage_progress(self, event):
+        self._event(name='progress', ph='C', ts=self._timestamp(),
+                    args={event.stage: event.fraction})
+
+    def stage_end(self, event):
+        if event.status == 'loaded':
+            self._event(name=event.stage, ph='i', s='t', ts=self._timestamp(),
+                        args={'status': 'loaded'})
+            return
+        self._event(name=event.stage, cat='worldgen', ph='X',
+                    ts=self._timestamp(event.wall), dur=event.wall * 1e6,
+                    args={'cpu': event.cpu, 'memory': event.memory, 'index': event.index})
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, f)
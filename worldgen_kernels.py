@@ -0,0 +1,208 @@
+"""Numba kernels for the world generator.
+
+The kernels only take plain numpy arrays and scalars, so they compile in
+nopython mode and are cached on disk between runs. Set the environment variable
+WORLDGEN_DISABLE_JIT=1 before importing worldgen to run them as ordinary Python
+functions, which makes them debuggable.
+"""
+import heapq
+import os
+import numpy as np
+from numba import njit, prange
+
+jit_enabled = os.environ.get('WORLDGEN_DISABLE_JIT', '0').lower() in ('', '0', 'false', 'no')
+
+
+def kernel(func):
+    "Compile `func` as a cached nopython kernel, unless JIT is disabled."
+    if jit_enabled:
+        return njit(cache=True)(func)
+    return func
+
+
+def parallel_kernel(func):
+    "Like kernel, but run the prange loops of `func` on all cores."
+    if jit_enabled:
+        return njit(cache=True, parallel=True)(func)
+    return func
+
+
+@kernel
+def land_curve(hm, sand_height):
+    "Flatten the land in place with a x^3 curve above `sand_height`."
+    height, width = hm.shape
+    for y in range(height):
+        for x in range(width):
+            h = hm[y, x]
+            if h >= sand_height:
+                coef = (h - sand_height) / (1.0 - sand_height)
+                hm[y, x] = sand_height + coef * coef * coef * (1.0 - sand_height)
+
+
+# Number of neighbouring lanes a thread sweeps in lockstep
+LANE_BLOCK = 64
+
+
+@parallel_kernel
+def precipitation_sweep(hm, precip, water, step, water_add, slope_coef, base_precip,
+                        sand_height):
+    """Blow wind along the rows of `hm`, one lane per column, raining into `precip`.
+
+    Lane x starts with `water[x]` and moves by `step` (1 or -1) rows at a time,
+    picking up water over the sea and dropping it on rising ground. Lanes are
+    independent: blocks of LANE_BLOCK of them are swept in lockstep, one row at
+    a time, and the blocks are spread over all cores. Pass transposed views to
+    sweep along the columns instead.
+    """
+    n = hm.shape[0]
+    lanes = water.shape[0]
+    for b in prange((lanes + LANE_BLOCK - 1) // LANE_BLOCK):
+        x0 = b * LANE_BLOCK
+        x1 = min(x0 + LANE_BLOCK, lanes)
+        water_amount = water[x0:x1].astype(np.float64)
+        for k in range(n):
+            y = k if step == 1 else n - 1 - k
+            for x in range(x0, x1):
+                h = hm[y, x]
+                if h < sand_height:
+                    water_amount[x - x0] += water_add
+                elif water_amount[x - x0] > 0.0:
+                    if 0 <= y + step < n:
+                        slope = hm[y + step, x] - h
+                    else:
+                        slope = h - hm[y - step, x]
+                    if slope >= 0:
+                        rain = water_amount[x - x0] * (base_precip + slope * slope_coef)
+                        precip[y, x] += rain
+                        water_amount[x - x0] = max(0.0, water_amount[x - x0] - rain)
+
+
+@kernel
+def add_hills(hm, xs, ys, radii, heights, x0, y0, x1, y1):
+    """Add a batch of hills to the window [x0, x1) x [y0, y1) of `hm`, in place.
+
+    Hill i is a paraboloid centred on (xs[i], ys[i]) of radius radii[i] and
+    peak height heights[i], as drawn by libtcod's heightmap_add_hill.
+    """
+    for i in range(xs.shape[0]):
+        hx, hy, radius = xs[i], ys[i], radii[i]
+        radius2 = radius * radius
+        if radius2 <= 0.0:  # Like heightmap_add_hill, a hill of radius 0 adds nothing
+            continue
+        coef = heights[i] / radius2
+        minx = max(x0, int(max(0.0, hx - radius)))
+        maxx = min(x1, int(min(hm.shape[1], hx + radius)))
+        miny = max(y0, int(max(0.0, hy - radius)))
+        maxy = min(y1, int(min(hm.shape[0], hy + radius)))
+        for y in range(miny, maxy):
+            ydist = (y - hy) * (y - hy)
+            for x in range(minx, maxx):
+                z = radius2 - (x - hx) * (x - hx) - ydist
+                if z > 0.0:
+                    hm[y, x] += z * coef
+
+
+@parallel_kernel
+def add_hills_tiled(hm, xs, ys, radii, heights, tile_size):
+    """Add a batch of hills to `hm` in place, one tile of `tile_size` cells square per thread.
+
+    Each tile only stamps the hills whose bounding box overlaps it.
+    """
+    height, width = hm.shape
+    ntx = (width + tile_size - 1) // tile_size
+    nty = (height + tile_size - 1) // tile_size
+    for t in prange(ntx * nty):
+        x0 = (t % ntx) * tile_size
+        y0 = (t // ntx) * tile_size
+        x1 = min(x0 + tile_size, width)
+        y1 = min(y0 + tile_size, height)
+        overlap = ((xs + radii > x0) & (xs - radii < x1)
+                   & (ys + radii > y0) & (ys - radii < y1))
+        sel = np.flatnonzero(overlap)
+        add_hills(hm, xs[sel], ys[sel], radii[sel], heights[sel], x0, y0, x1, y1)
+
+
+@parallel_kernel
+def box_blur_rows(src, dst, radius):
+    """Average each cell of `src` with its `radius` neighbours on either side along the rows.
+
+    Writes the result to `dst`; near the edges only the cells on the map are
+    averaged. A running sum adds the cell entering the window and subtracts
+    the one leaving it, in float64, so the cost does not depend on the radius.
+    Rows are spread over all cores.
+    """
+    height, width = src.shape
+    for y in prange(height):
+        total = 0.0
+        for x in range(min(radius, width)):
+            total += src[y, x]
+        for x in range(width):
+            if x + radius < width:
+                total += src[y, x + radius]
+            if x - radius - 1 >= 0:
+                total -= src[y, x - radius - 1]
+            dst[y, x] = total / (min(x + radius, width - 1) - max(x - radius, 0) + 1)
+
+
+@parallel_kernel
+def box_blur_columns(src, dst, radius):
+    """Like box_blur_rows along the columns.
+
+    Blocks of LANE_BLOCK columns keep one running sum per column and sweep
+    the rows in order, which stays cache friendly; the blocks are spread over
+    all cores.
+    """
+    height, width = src.shape
+    for b in prange((width + LANE_BLOCK - 1) // LANE_BLOCK):
+        x0 = b * LANE_BLOCK
+        x1 = min(x0 + LANE_BLOCK, width)
+        total = np.zeros(x1 - x0)
+        for y in range(min(radius, height)):
+            for x in range(x0, x1):
+                total[x - x0] += src[y, x]
+        for y in range(height):
+            if y + radius < height:
+                for x in range(x0, x1):
+                    total[x - x0] += src[y + radius, x]
+            if y - radius - 1 >= 0:
+                for x in range(x0, x1):
+                    total[x - x0] -= src[y - radius - 1, x]
+            count = min(y + radius, height - 1) - max(y - radius, 0) + 1
+            for x in range(x0, x1):
+                dst[y, x] = total[x - x0] / count
+
+
+@kernel
+def priority_flood(hm, seeds, dirx, diry, oppdir):
+    """Flood `hm` inwards from the flat indexes `seeds`, lowest cells first.
+
+    Returns the filled heightmap, where every depression is raised to the
+    level of its spill point, and the direction from each cell to the cell
+    that flooded it (0 for the seeds). Following those directions leads every
+    cell out of its depressions to a seed; cells flooded at equal levels are
+    taken in the order they were reached.
+    """
+    height, width = hm.shape
+    filled = hm.astype(np.float64)
+    parent = np.zeros((height, width), np.int8)
+    done = np.zeros((height, width), np.bool_)
+    heap = [(0.0, 0, 0)]
+    heap.pop()
+    for order in range(seeds.shape[0]):
+        y, x = seeds[order] // width, seeds[order] % width
+        done[y, x] = True
+        heapq.heappush(heap, (filled[y, x], order, seeds[order]))
+    order = seeds.shape[0]
+    while heap:
+        level, _, i = heapq.heappop(heap)
+        y, x = i // width, i % width
+        for d in range(1, 9):
+            ny, nx = y + diry[d], x + dirx[d]
+            if ny < 0 or ny >= height or nx < 0 or nx >= width or done[ny, nx]:
+                continue
+            done[ny, nx] = True
+            filled[ny, nx] = max(filled[ny, nx], level)
+            parent[ny, nx] = oppdir[d]
+            heapq.heappush(heap, (filled[ny, nx], order, ny * width + nx))
+            order += 1
+    return filled, parent
@@ -0,0 +1,162 @@
+"""Checkpointed, resumable runs of the world generation stages.
+
+Pipeline runs worldgen.STAGES like WorldGenerator.generate, but saves the
+outputs of every stage to an .npz checkpoint. Each checkpoint is named after a
+key chaining the map size, the world seed, a hash of the generator's source
+(see code_version), and the names and parameters of its
+stage and of all the stages before it. A later run with the
+same settings loads the checkpoints instead of recomputing them; changing a
+parameter only re-runs the stages from the first one depending on it, and a
+run interrupted by a crash resumes after its last completed stage.
+"""
+import functools
+import hashlib
+import json
+import os
+
+import numpy as np
+
+import worldgen
+from worldgen import River, StageProgress
+
+
+_code_files = ('worldgen.py', 'worldgen_kernels.py')
+
+
+@functools.lru_cache()
+def code_version():
+    "Hash of the source of the world generator."
+    digest = hashlib.sha256()
+    here = os.path.dirname(os.path.abspath(__file__))
+    for name in _code_files:
+        with open(os.path.join(here, name), 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def get_value(wg, name):
+    "Read the (possibly dotted) attribute `name` of the generator `wg`."
+    obj = wg
+    for part in name.split('.'):
+        obj = obj[part] if isinstance(obj, dict) else getattr(obj, part)
+    return obj
+
+
+def set_value(wg, name, value):
+    "Set the (possibly dotted) attribute `name` of the generator `wg`."
+    *path, last = name.split('.')
+    obj = get_value(wg, '.'.join(path)) if path else wg
+    if isinstance(obj, dict):
+        obj[last] = value
+    else:
+        setattr(obj, last, value)
+
+
+def encode(name, value):
+    "The arrays saving attribute `name`, keyed by their name in the checkpoint."
+    if name == 'rivers':
+        coords = [river.coords for river in value]
+        return {
+            'rivers.coords': np.array([c for cs in coords for c in cs], np.int32).reshape(-1, 2),
+            'rivers.offsets': np.cumsum([0] + [len(cs) for cs in coords]),
+            'rivers.strength': np.array([river.strength for river in value], np.float64),
+        }
+    return {name: np.asarray(value)}
+
+
+def decode(name, data):
+    "Inverse of encode: rebuild attribute `name` from the loaded checkpoint `data`."
+    if name == 'rivers':
+        coords, offsets = data['rivers.coords'], data['rivers.offsets']
+        return [River([tuple(c) for c in coords[start:end].tolist()], float(strength))
+                for start, end, strength in zip(offsets[:-1], offsets[1:], data['rivers.strength'])]
+    return data[name]
+
+
+class Pipeline(object):
+    """Run `stages` on a WorldGenerator, checkpointing each one into `checkpoint_dir`."""
+
+    def __init__(self, checkpoint_dir, stages=None):
+        self.checkpoint_dir = checkpoint_dir
+        self.stages = worldgen.STAGES if stages is None else stages
+        self.check_graph()
+
+    def check_graph(self):
+        "Ensure each stage only reads attributes that the stages before it produce."
+        produced = set()
+        for stage in self.stages:
+            missing = [name for name in stage.inputs
+                       if name not in produced and not name.startswith('map_data.')]
+            if missing:
+                raise ValueError('Stage {} reads {} before any stage writes it'.format(
+                    stage.name, ', '.join(missing)))
+            produced.update(stage.outputs)
+
+    def keys(self, wg):
+        "The chained checkpoint key of every stage for the generator `wg`."
+        root = {'width': wg.width, 'height': wg.height, 'seed': wg.seed_seq.entropy,
+                'code': code_version()}
+        key = hashlib.sha256(json.dumps(root).encode()).hexdigest()
+        keys = []
+        for stage in self.stages:
+            params = {name: get_value(wg, name) for name in stage.params}
+            blob = json.dumps([key, stage.name, params], sort_keys=True)
+            key = hashlib.sha256(blob.encode()).hexdigest()
+            keys.append(key)
+        return keys
+
+    def checkpoint_path(self, index, key):
+        stage = self.stages[index]
+        return os.path.join(self.checkpoint_dir,
+                            '{:02d}-{}-{}.npz'.format(index, stage.name, key[:16]))
+
+    def completed(self, keys):
+        "Number of leading stages whose checkpoints all exist."
+        for i, key in enumerate(keys):
+            if not os.path.exists(self.checkpoint_path(i, key)):
+                return i
+        return len(keys)
+
+    def save(self, wg, index, key):
+        "Atomically write the outputs of stage `index`."
+        arrays = {}
+        for name in self.stages[index].outputs:
+            arrays.update(encode(name, get_value(wg, name)))
+        path = self.checkpoint_path(index, key)
+        tmp = path + '.tmp.npz'
+        np.savez(tmp, **arrays)
+        os.replace(tmp, path)
+
+    def load(self, wg, done, keys):
+        "Restore `wg` to its state after the first `done` stages."
+        latest = {}
+        for i in range(done):
+            for name in self.stages[i].outputs:
+                latest[name] = i
+        data = {i: np.load(self.checkpoint_path(i, keys[i])) for i in set(latest.values())}
+        for name, i in latest.items():
+            set_value(wg, name, decode(name, data[i]))
+        for d in data.values():
+            d.close()
+
+    def run(self, wg, progress=None):
+        """Bring `wg` through every stage, loading what the checkpoints already hold.
+
+        `progress`, if given, is called with a StageProgress whose status is
+        'loaded' for the stages restored from checkpoints, and 'start', any
+        'progress' and then 'done' for the stages that run.
+        """
+        os.makedirs(self.checkpoint_dir, exist_ok=True)
+        keys = self.keys(wg)
+        count = len(self.stages)
+        done = self.completed(keys)
+        if done:
+            self.load(wg, done, keys)
+        for i, stage in enumerate(self.stages):
+            if i < done:
+                if progress is not None:
+                    progress(StageProgress(stage.name, i, count, 'loaded'))
+                continue
+            worldgen.run_stage(wg, self.stages, i, progress)
+            self.save(wg, i, keys[i])
+        return wg
@@ -0,0 +1,120 @@
+"""Multi-resolution pyramid of a generated world, for zoomed out map views.
+
+WorldPyramid holds the height, precipitation, temperature, biome and color
+layers of a world at successive halvings of its resolution, like the mipmaps
+of a texture. Level 0 is the world itself, without copies; each level above
+averages 2x2 blocks of the one below, except for biomes, which take the most
+common biome of the block. The pyramid adds a third to the memory of the
+layers and is built once after generation:
+
+    pyramid = WorldPyramid.build(wg)
+    level = pyramid.level_for_scale(16)  # 16 world cells per screen cell
+    colors = pyramid.rect('colors.biome', x0, y0, x1, y1, level)
+
+Levels are pooled in bands of rows, so building the pyramid of a
+memory-mapped world (see worldgen_store) never loads the whole map.
+"""
+import math
+
+import numpy as np
+
+# Pyramid layers read from the generator, and whether they are averaged or mode-pooled
+layers = (('height', '_hm', 'mean'), ('precipitation', '_precipitation', 'mean'),
+          ('temperature', '_hm_temperature', 'mean'), ('biome', '_biome_map', 'mode'))
+
+
+def _blocks(arr):
+    "Split `arr`, padded to even dimensions by repeating its edges, into 2x2 blocks."
+    h, w = arr.shape[:2]
+    pad = [(0, h % 2), (0, w % 2)] + [(0, 0)] * (arr.ndim - 2)
+    if h % 2 or w % 2:
+        arr = np.pad(arr, pad, mode='edge')
+    h2, w2 = arr.shape[0] // 2, arr.shape[1] // 2
+    return arr.reshape((h2, 2, w2, 2) + arr.shape[2:])
+
+
+def mean_pool(arr):
+    "Average 2x2 blocks of `arr`, rounding integer arrays; odd edges are repeated."
+    mean = _blocks(arr).mean(axis=(1, 3), dtype=np.float64)
+    if np.issubdtype(arr.dtype, np.integer):
+        mean = np.rint(mean)
+    return mean.astype(arr.dtype)
+
+
+def mode_pool(arr):
+    """The most common value of each 2x2 block of the 2D array `arr`.
+
+    Ties go to the first of the block in row order. Odd edges are repeated.
+    """
+    blocks = _blocks(arr)
+    values = blocks.transpose(0, 2, 1, 3).reshape(blocks.shape[0], blocks.shape[2], 4)
+    counts = (values[..., :, None] == values[..., None, :]).sum(axis=-1)
+    return np.take_along_axis(values, counts.argmax(axis=-1)[..., None], axis=-1)[..., 0]
+
+
+def downsample(arr, pool, band=1024):
+    "Pool `arr` with `pool` (mean_pool or mode_pool), `band` rows at a time."
+    band += band % 2
+    h, w = arr.shape[:2]
+    out = np.empty(((h + 1) // 2, (w + 1) // 2) + arr.shape[2:], arr.dtype)
+    for y in range(0, h, band):
+        out[y // 2:(min(y + band, h) + 1) // 2] = pool(np.asarray(arr[y:y + band]))
+    return out
+
+
+class WorldPyramid(object):
+    """Layers of a world at 1, 1/2, 1/4... of its resolution.
+
+    levels[k] maps layer names to arrays 2**k times smaller than the world
+    along each axis (rounded up). The layer names are those of `layers` and
+    'colors.<view>' for every color view of the generator.
+    """
+
+    def __init__(self, width, height, levels):
+        self.width = width
+        self.height = height
+        self.levels = levels
+
+    @classmethod
+    def build(cls, wg, min_size=32, band=1024):
+        """The pyramid of the generated world `wg`.
+
+        Levels are added until both dimensions of the smallest one are at most
+        `min_size` cells.
+        """
+        base = {name: getattr(wg, attr) for name, attr, _ in layers}
+        base.update({'colors.' + view: image for view, image in wg._colors.items()})
+        pools = {name: mode_pool if how == 'mode' else mean_pool for name, _, how in layers}
+        levels = [base]
+        while max(levels[-1]['height'].shape) > min_size:
+            levels.append({name: downsample(arr, pools.get(name, mean_pool), band)
+                           for name, arr in levels[-1].items()})
+        return cls(wg.width, wg.height, levels)
+
+    @property
+    def nbytes(self):
+        "Memory used by the downsampled levels; level 0 is the world's own."
+        return sum(arr.nbytes for level in self.levels[1:] for arr in level.values())
+
+    def shape(self, level):
+        "(height, width) of `level`."
+        return self.levels[level]['height'].shape
+
+    def level_for_scale(self, scale):
+        "The finest level with at least one cell per `scale` world cells, clamped to the pyramid."
+        if scale <= 1:
+            return 0
+        return min(int(math.floor(math.log2(scale))), len(self.levels) - 1)
+
+    def rect(self, layer, x0, y0, x1, y1, level=0):
+        """The cells of `layer` at `level` covering the world rectangle [x0, x1) x [y0, y1).
+
+        Coordinates are in world cells and clipped to the map; the rectangle is
+        widened to whole cells of the level. Returns a view, not a copy.
+        """
+        factor = 1 << level
+        arr = self.levels[level][layer]
+        h, w = arr.shape[:2]
+        lx0, ly0 = max(0, x0 // factor), max(0, y0 // factor)
+        lx1, ly1 = min(w, -(-x1 // factor)), min(h, -(-y1 // factor))
+        return arr[ly0:max(ly0, ly1), lx0:max(lx0, lx1)]
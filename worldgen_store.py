@@ -0,0 +1,156 @@
+"""Memory-mapped storage of the layers of a WorldGenerator.
+
+A world directory holds every per-cell array of a generated world as a raw
+numpy.memmap file, next to a world.json header listing the map size, the
+generator settings and the dtype, shape and file of each layer. The stages of
+WorldGenerator write their layers in place, so once WorldStore.create has bound
+the layers of a generator to fresh files, generation writes straight to disk
+and the OS pages the map in and out as needed. WorldStore.open maps an existing
+world, read-only by default, so any number of processes share a single copy of
+it in the page cache.
+
+The river list is not a per-cell layer: flush saves it as .npy files.
+"""
+import json
+import os
+
+import numpy as np
+
+import worldgen
+from worldgen_cache import settings
+from worldgen_pipeline import get_value, set_value, encode, decode
+
+VERSION = 1
+HEADER = 'world.json'
+
+
+def header_settings(wg):
+    """The settings of `wg` as stored in world.json.
+
+    A bytes seed is stored as its integer entropy, which seeds the same world.
+    """
+    params = {name: getattr(wg, name) for name in settings}
+    if isinstance(params['seed'], bytes):
+        params['seed'] = worldgen.seed_entropy(params['seed'])
+    return params
+
+
+def write_header(directory, header):
+    "Atomically (re)write the world.json of `directory`."
+    tmp = os.path.join(directory, HEADER + '.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(header, f, indent=1, sort_keys=True)
+    os.replace(tmp, os.path.join(directory, HEADER))
+
+
+def layers(width, height):
+    "(name, dtype, shape) of every per-cell array of a world, by dotted attribute name."
+    shape = (height, width)
+    specs = [(name, np.float32, shape) for name in
+             ('_hm', '_hm2', '_precipitation', '_hm_temperature', 'clouds.columns')]
+    specs.append(('_biome_map', np.uint8, shape))
+    specs += [('map_data.' + name, dtype, shape) for name, dtype in worldgen.MapDataGrid.fields]
+    specs += [('_colors.' + view, np.uint8, shape + (3,)) for view in worldgen.color_views]
+    return specs
+
+
+class WorldStore(object):
+    """The layers of the world in `directory`, described by `header` and mapped with `mode`.
+
+    Use create and open rather than the constructor. `mode` is a numpy.memmap
+    mode: 'w+' for a new world, 'r+' to modify one and 'r' to only read it. In
+    'r' mode the cloud columns are mapped copy-on-write, so that every process
+    can scroll its own clouds.
+    """
+
+    def __init__(self, directory, header, mode):
+        self.directory = directory
+        self.header = header
+        self.mode = mode
+        self.wg = None
+        self.arrays = {}
+        for name, spec in header['layers'].items():
+            layer_mode = 'c' if mode == 'r' and name == 'clouds.columns' else mode
+            self.arrays[name] = np.memmap(self.path(spec['file']), np.dtype(spec['dtype']),
+                                          layer_mode, shape=tuple(spec['shape']))
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    @classmethod
+    def create(cls, directory, wg):
+        """Start a world in `directory` for the generator `wg` and bind its layers to it.
+
+        Any world already in `directory` is overwritten. The layers of `wg` are
+        replaced by zeroed memory maps; call flush once `wg` is generated. The
+        header is written before the layer files, so a world whose settings
+        cannot be stored leaves nothing behind.
+        """
+        header = {
+            'version': VERSION,
+            'width': wg.width,
+            'height': wg.height,
+            'settings': header_settings(wg),
+            'layers': {name: {'dtype': np.dtype(dtype).str, 'shape': list(shape),
+                              'file': name + '.bin'}
+                       for name, dtype, shape in layers(wg.width, wg.height)},
+            'rivers': None,
+        }
+        os.makedirs(directory, exist_ok=True)
+        write_header(directory, header)
+        store = cls(directory, header, 'w+')
+        store.bind(wg)
+        return store
+
+    @classmethod
+    def open(cls, directory, mode='r'):
+        "Map the world in `directory`, read-only unless `mode` is 'r+'."
+        if mode not in ('r', 'r+'):
+            raise ValueError('Cannot open a world with mode {!r}'.format(mode))
+        with open(os.path.join(directory, HEADER)) as f:
+            header = json.load(f)
+        if header['version'] != VERSION:
+            raise ValueError('Unsupported world version {}'.format(header['version']))
+        return cls(directory, header, mode)
+
+    def bind(self, wg):
+        "Make the layers of the generator `wg` the memory maps of this world."
+        if (wg.width, wg.height) != (self.header['width'], self.header['height']):
+            raise ValueError('World is {}x{}, generator is {}x{}'.format(
+                self.header['width'], self.header['height'], wg.width, wg.height))
+        for name, arr in self.arrays.items():
+            set_value(wg, name, arr)
+        if self.header['rivers'] is not None:
+            wg.rivers = decode('rivers', {name: np.load(self.path(file))
+                                          for name, file in self.header['rivers'].items()})
+        self.wg = wg
+        return wg
+
+    def world(self):
+        "A WorldGenerator with the settings of this world, its layers bound to it."
+        return self.bind(worldgen.WorldGenerator(**self.header['settings']))
+
+    def flush(self):
+        "Write the layers and rivers of the bound generator to disk."
+        if self.mode == 'r':
+            return
+        for name, arr in self.arrays.items():
+            if get_value(self.wg, name) is not arr:
+                raise ValueError('Layer {} of the generator was replaced'.format(name))
+            arr.flush()
+        files = {}
+        for name, arr in encode('rivers', self.wg.rivers).items():
+            files[name] = name + '.npy'
+            np.save(self.path(files[name]), arr)
+        self.header['rivers'] = files
+        write_header(self.directory, self.header)
+
+    def generate(self, progress=None):
+        "Generate the bound world onto disk."
+        self.wg.generate(progress=progress)
+        self.flush()
+        return self.wg
+
+    @property
+    def nbytes(self):
+        return sum(arr.nbytes for arr in self.arrays.values())
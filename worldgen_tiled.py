@@ -0,0 +1,373 @@
+"""Tiled, multi-process world generation for very large maps.
+
+generate_tiled runs the stages of WorldGenerator.generate with the map held in
+multiprocessing.shared_memory and the work split into tiles farmed out to a
+ProcessPoolExecutor. Each tile task reads a window of the map made of its tile
+and a halo wide enough for the stage (none for noise and climate, one cell for
+the smoothing kernel, the blur radius for the precipitation blur, the color
+blending spread, and erosion_halo for erosion) and only writes its own tile,
+into a separate output array when the stage reads its neighbours, so tiles
+never see each other's results and stitch without seams.
+
+The steps that need the whole map run in the parent process between tile
+batches: min/max normalization, the land mass histogram, the low resolution
+precipitation blur and the river network. The wind sweeps are split into
+strips of whole rows or columns instead of tiles.
+
+Everything but erosion matches WorldGenerator.generate exactly, except for the
+biome color jitter, which draws from a separate random stream per tile. Flow
+paths longer than erosion_halo are cut at the halo, so erosion only matches
+when the halo covers the map.
+"""
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+from multiprocessing import shared_memory
+
+import numpy as np
+import tcod
+
+import worldgen
+import worldgen_kernels as kernels
+from worldgen import SAND_HEIGHT, StageProgress
+
+
+class SharedArrays(object):
+    """Named arrays in shared memory that worker processes attach to by spec."""
+
+    def __init__(self):
+        self.blocks = {}
+        self.arrays = {}
+
+    def create(self, name, shape, dtype, value=None):
+        dtype = np.dtype(dtype)
+        size = max(1, int(np.prod(shape)) * dtype.itemsize)
+        block = shared_memory.SharedMemory(create=True, size=size)
+        arr = np.ndarray(shape, dtype, buffer=block.buf)
+        arr[...] = 0 if value is None else value
+        self.blocks[name], self.arrays[name] = block, arr
+        return arr
+
+    def swap(self, a, b):
+        "Exchange the arrays named `a` and `b`."
+        self.blocks[a], self.blocks[b] = self.blocks[b], self.blocks[a]
+        self.arrays[a], self.arrays[b] = self.arrays[b], self.arrays[a]
+
+    def spec(self):
+        "What attach needs to map the arrays in another process."
+        return {name: (self.blocks[name].name, arr.shape, arr.dtype.str)
+                for name, arr in self.arrays.items()}
+
+    def close(self):
+        self.arrays.clear()
+        for block in self.blocks.values():
+            block.close()
+            block.unlink()
+        self.blocks.clear()
+
+
+_attached = {}
+
+
+def attach(spec):
+    "Map the arrays of SharedArrays.spec into this process, reusing earlier mappings."
+    arrays = {}
+    for name, (block_name, shape, dtype) in spec.items():
+        if block_name not in _attached:
+            _attached[block_name] = shared_memory.SharedMemory(name=block_name)
+        arrays[name] = np.ndarray(shape, np.dtype(dtype), buffer=_attached[block_name].buf)
+    return arrays
+
+
+def _run_task(task, spec, rect, kwargs):
+    task(attach(spec), rect, **kwargs)
+
+
+def tile_rects(width, height, tile_size):
+    "(x0, y0, x1, y1) of the tiles covering a width x height map."
+    return [(x0, y0, min(x0 + tile_size, width), min(y0 + tile_size, height))
+            for y0 in range(0, height, tile_size) for x0 in range(0, width, tile_size)]
+
+
+def window(rect, halo, shape):
+    """Slices of the window of `rect` grown by `halo` cells, and of `rect` within it."""
+    x0, y0, x1, y1 = rect
+    height, width = shape
+    wx0, wy0 = max(0, x0 - halo), max(0, y0 - halo)
+    wx1, wy1 = min(width, x1 + halo), min(height, y1 + halo)
+    return ((slice(wy0, wy1), slice(wx0, wx1)),
+            (slice(y0 - wy0, y1 - wy0), slice(x0 - wx0, x1 - wx0)))
+
+
+# Tile tasks
+# ----------
+#
+# Each task gets the shared arrays by name and the rect of its tile, and only
+# writes inside that rect.
+
+_noises = {}
+
+
+def _noise(dimensions, seed):
+    if (dimensions, seed) not in _noises:
+        _noises[dimensions, seed] = tcod.noise.Noise(dimensions, seed=seed)
+    return _noises[dimensions, seed]
+
+
+def _stamp_hills_task(arrays, rect, xs, ys, radii, heights):
+    x0, y0, x1, y1 = rect
+    sel = (xs + radii > x0) & (xs - radii < x1) & (ys + radii > y0) & (ys - radii < y1)
+    kernels.add_hills(arrays['hm'], xs[sel], ys[sel], radii[sel], heights[sel], x0, y0, x1, y1)
+
+
+def _base_noise_task(arrays, rect, seed):
+    x0, y0, x1, y1 = rect
+    height, width = arrays['hm'].shape
+    noise = _noise(2, seed)
+    xs, ys = np.arange(x0, x1), np.arange(y0, y1)
+    arrays['hm'][y0:y1, x0:x1] += worldgen.fbm_layer(
+        noise, xs, ys, width, height, worldgen.FBM_FREQUENCY * width,
+        worldgen.FBM_OCTAVES, worldgen.FBM_DELTA, worldgen.FBM_SCALE)
+    arrays['clouds'][y0:y1, x0:x1] = worldgen.cloud_layer(noise, xs, ys, width, height)
+
+
+def _land_task(arrays, rect, water_level):
+    x0, y0, x1, y1 = rect
+    hm = arrays['hm'][y0:y1, x0:x1]
+    hm[:] = worldgen.water_level_remap(hm, water_level, SAND_HEIGHT)
+    kernels.land_curve(hm, SAND_HEIGHT)
+
+
+def _sweep_task(arrays, rect, axis, waters, water_add, slope_coef, base_precip):
+    "Sweep the wind lanes of a strip of columns (axis 0) or rows (axis 1) both ways."
+    x0, y0, x1, y1 = rect
+    if axis == 0:
+        hm, precip, lanes = arrays['hm'][:, x0:x1], arrays['precip'][:, x0:x1], slice(x0, x1)
+    else:
+        hm, precip, lanes = arrays['hm'][y0:y1].T, arrays['precip'][y0:y1].T, slice(y0, y1)
+    for step, water in zip((-1, 1), waters):
+        kernels.precipitation_sweep(hm, precip, water[lanes], step, water_add, slope_coef,
+                                    base_precip, SAND_HEIGHT)
+
+
+def _latitude_task(arrays, rect, seed, spread):
+    x0, y0, x1, y1 = rect
+    height, width = arrays['precip'].shape
+    ys = np.arange(max(y0, height // 4), min(y1, 3 * height // 4))
+    if ys.size:
+        arrays['precip'][ys[0]:ys[-1] + 1, x0:x1] += worldgen.latitude_precipitation(
+            _noise(2, seed), ys, np.arange(x0, x1), width, height, spread)
+
+
+def _upsample_task(arrays, rect, factor):
+    x0, y0, x1, y1 = rect
+    xs, ys = np.arange(x0, x1) / factor, np.arange(y0, y1) / factor
+    arrays['precip'][y0:y1, x0:x1] = worldgen.interpolate_bilinear(
+        arrays['low_res'], xs[None, :], ys[:, None])
+
+
+def _erosion_task(arrays, rect, halo, iterations, erosion_factor, sedimentation_factor,
+                  max_erosion_alt, mudslide_coef):
+    win, core = window(rect, halo, arrays['hm'].shape)
+    x0, y0, x1, y1 = rect
+    hm, flow_dir, up_dir, slope = worldgen.erode(
+        arrays['hm'][win], worldgen.precipitation_to_cm(arrays['precip'][win]), iterations,
+        erosion_factor, sedimentation_factor)
+    hm = worldgen.mudslide(hm, max_erosion_alt, mudslide_coef)
+    arrays['hm_out'][y0:y1, x0:x1] = hm[core]
+    arrays['flow_dir'][y0:y1, x0:x1] = flow_dir[core]
+    arrays['up_dir'][y0:y1, x0:x1] = up_dir[core]
+    arrays['slope'][y0:y1, x0:x1] = slope[core]
+    arrays['in_flags'][y0:y1, x0:x1] = worldgen.inflow_flags(flow_dir)[core]
+
+
+def _smooth_task(arrays, rect, pairs):
+    x0, y0, x1, y1 = rect
+    for src, dst in pairs:
+        win, core = window(rect, 1, arrays[src].shape)
+        hm = arrays[src][win].copy()
+        worldgen.smooth(hm)
+        arrays[dst][y0:y1, x0:x1] = hm[core]
+
+
+def _blur_task(arrays, rect, radius, passes):
+    x0, y0, x1, y1 = rect
+    win, core = window(rect, radius * passes, arrays['precip'].shape)
+    arrays['precip_out'][y0:y1, x0:x1] = worldgen.box_blur(
+        arrays['precip'][win], radius, passes)[core]
+
+
+def _climate_task(arrays, rect):
+    x0, y0, x1, y1 = rect
+    height = arrays['hm'].shape[0]
+    temperature, biome = worldgen.temperatures_and_biomes(
+        arrays['hm'][y0:y1, x0:x1], arrays['precip'][y0:y1, x0:x1], np.arange(y0, y1), height)
+    arrays['temperature'][y0:y1, x0:x1] = temperature
+    arrays['biome'][y0:y1, x0:x1] = biome
+
+
+def _colors_task(arrays, rect, halo, seed_seq):
+    x0, y0, x1, y1 = rect
+    win, core = window(rect, halo, arrays['hm'].shape)
+    colors = worldgen.colorize(arrays['hm'][win], arrays['precip'][win],
+                               arrays['temperature'][win], arrays['biome'][win],
+                               np.random.default_rng(seed_seq))
+    for view in worldgen.color_views:
+        arrays['color_' + view][y0:y1, x0:x1] = colors[view][core]
+
+
+class TiledRun(object):
+    """Run tile tasks on the shared arrays, in `executor` or in this process if None."""
+
+    def __init__(self, shared, tile_size, executor=None):
+        self.shared = shared
+        self.tile_size = tile_size
+        self.executor = executor
+
+    @property
+    def shape(self):
+        return self.shared.arrays['hm'].shape
+
+    def tiles(self):
+        height, width = self.shape
+        return tile_rects(width, height, self.tile_size)
+
+    def strips(self, axis):
+        "Strips of whole columns (axis 0) or rows (axis 1), one tile_size wide."
+        height, width = self.shape
+        if axis == 0:
+            return [(x0, 0, min(x0 + self.tile_size, width), height)
+                    for x0 in range(0, width, self.tile_size)]
+        return [(0, y0, width, min(y0 + self.tile_size, height))
+                for y0 in range(0, height, self.tile_size)]
+
+    def map(self, task, rects=None, per_tile=None, **kwargs):
+        """Run `task` on every rect of `rects` (by default the tiles) and wait for all.
+
+        `per_tile(i)`, if given, returns extra keyword arguments for the i-th rect.
+        """
+        rects = self.tiles() if rects is None else rects
+        args = [dict(kwargs, **(per_tile(i) if per_tile else {})) for i in range(len(rects))]
+        if self.executor is None:
+            for rect, kw in zip(rects, args):
+                task(self.shared.arrays, rect, **kw)
+            return
+        spec = self.shared.spec()
+        futures = [self.executor.submit(_run_task, task, spec, rect, kw)
+                   for rect, kw in zip(rects, args)]
+        for future in futures:
+            future.result()
+
+
+def generate_tiled(wg, tile_size=1024, workers=None, erosion_halo=64, progress=None):
+    """Generate the world of `wg` in tiles of `tile_size` cells square on `workers` processes.
+
+    workers=0 runs the tiles in this process. `progress` receives a
+    StageProgress as each of worldgen.STAGES starts and finishes.
+    """
+    shared = SharedArrays()
+    # Forking after numba started its thread pool can deadlock the workers
+    executor = None if workers == 0 else ProcessPoolExecutor(
+        workers, mp_context=multiprocessing.get_context('spawn'))
+    stages = [stage.name for stage in worldgen.STAGES]
+
+    def report(index, status):
+        if progress is not None:
+            progress(StageProgress(stages[index], index, len(stages), status))
+
+    try:
+        shape = (wg.height, wg.width)
+        for name, dtype in [('hm', np.float32), ('hm_out', np.float32), ('hm2', np.float32),
+                            ('hm2_out', np.float32), ('clouds', np.float32),
+                            ('precip', np.float32), ('precip_out', np.float32),
+                            ('temperature', np.float32), ('biome', np.uint8)]:
+            shared.create(name, shape, dtype)
+        for name, dtype in worldgen.MapDataGrid.fields:
+            shared.create(name, shape, dtype)
+        for view in worldgen.color_views:
+            shared.create('color_' + view, shape + (3,), np.uint8)
+        run = TiledRun(shared, tile_size, executor)
+        arrays = shared.arrays
+        noise2d = worldgen.noise_seed(wg.seed_stream('noise2d'))
+
+        report(0, 'start')
+        xs, ys, radii = wg.draw_hills(wg.hill_cnt, worldgen.HILL_RADIUS * wg.width,
+                                      worldgen.HILL_RADIUS_VAR, wg.rng('base_map'))
+        run.map(_stamp_hills_task, xs=xs.astype(np.float64), ys=ys.astype(np.float64),
+                radii=radii.astype(np.float64),
+                heights=np.full(len(xs), worldgen.HILL_HEIGHT))
+        tcod.heightmap_normalize(arrays['hm'])
+        run.map(_base_noise_task, seed=noise2d)
+        tcod.heightmap_normalize(arrays['hm'])
+        arrays['hm2'][:] = arrays['hm']
+        run.map(_land_task, water_level=worldgen.find_water_level(arrays['hm'], wg.land_mass))
+        report(0, 'done')
+
+        report(1, 'start')
+        water_add, slope_coef, base_precip = 0.03, 2.0, 0.01
+        for axis, n in ((0, wg.width), (1, wg.height)):
+            lanes = np.arange(n - 1) * 5 / n
+            waters = [1.0 + worldgen.sample_noise(wg.noise1d, [lanes], 3.0) for _ in range(2)]
+            run.map(_sweep_task, run.strips(axis), axis=axis, waters=waters,
+                    water_add=water_add, slope_coef=slope_coef, base_precip=base_precip)
+        spread = arrays['precip'].max() - arrays['precip'].min()
+        run.map(_latitude_task, seed=noise2d, spread=spread)
+        factor = 8
+        low_res = worldgen.block_reduce(arrays['precip'], factor)
+        shared.create('low_res', low_res.shape, low_res.dtype, low_res)
+        run.map(_upsample_task, factor=factor)
+        report(1, 'done')
+
+        report(2, 'start')
+        run.map(_erosion_task, halo=erosion_halo, iterations=4,
+                erosion_factor=wg.erosion_factor, sedimentation_factor=wg.sedimentation_factor,
+                max_erosion_alt=wg.max_erosion_alt, mudslide_coef=wg.mudslide_coef)
+        shared.swap('hm', 'hm_out')
+        report(2, 'done')
+
+        report(3, 'start')
+        run.map(_smooth_task, pairs=[('hm', 'hm_out'), ('hm2', 'hm2_out')])
+        shared.swap('hm', 'hm_out')
+        shared.swap('hm2', 'hm2_out')
+        tcod.heightmap_normalize(arrays['hm'])
+        arrays['hm'][:] = worldgen.land_mass_remap(arrays['hm'], wg.land_mass, SAND_HEIGHT)
+        report(3, 'done')
+
+        # Rivers follow drainage across the whole map. They run on the generator's
+        # own layers, never rebound to the shared arrays that close unmaps
+        report(4, 'start')
+        wg._hm[:], wg._precipitation[:] = arrays['hm'], arrays['precip']
+        for name, _ in worldgen.MapDataGrid.fields:
+            getattr(wg.map_data, name)[:] = arrays[name]
+        wg.generate_rivers()
+        arrays['precip'][:] = wg._precipitation
+        report(4, 'done')
+
+        report(5, 'start')
+        run.map(_blur_task, radius=2, passes=4)
+        shared.swap('precip', 'precip_out')
+        tcod.heightmap_normalize(arrays['precip'])
+        report(5, 'done')
+
+        report(6, 'start')
+        run.map(_climate_task)
+        report(6, 'done')
+
+        report(7, 'start')
+        colors = wg.seed_stream('colors')
+        run.map(_colors_task, halo=10,
+                per_tile=lambda i: {'seed_seq': np.random.SeedSequence(
+                    colors.entropy, spawn_key=colors.spawn_key + (i,))})
+        report(7, 'done')
+
+        # Copy the result into the generator's own layers, which may be memory-mapped
+        wg._precipitation[:] = arrays['precip']
+        wg._hm2[:] = arrays['hm2']
+        wg.clouds.reset(arrays['clouds'])
+        wg._hm_temperature[:] = arrays['temperature']
+        wg._biome_map[:] = arrays['biome']
+        wg.set_colors({view: arrays['color_' + view].copy() for view in worldgen.color_views})
+        return wg
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        shared.close()